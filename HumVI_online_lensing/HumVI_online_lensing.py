@@ -11,7 +11,7 @@ import os
 
 # =====================================================================
 
-def rgb_composer(rfile, gfile, bfile, source_r, source_g, source_b):
+def rgb_composer(rfile, gfile, bfile, source_r=None, source_g=None, source_b=None):
     """
     NAME
         compose.py
@@ -110,10 +110,40 @@ def rgb_composer(rfile, gfile, bfile, source_r, source_g, source_b):
 
     # -------------------------------------------------------------------
 
+    # Compose the image!
 
-    vb = False
+    image=humvi.compose_mod.compose(rfile, gfile, bfile, source_r, source_g, source_b, outfile="color.png", **composer_settings())
+
+    return image
 
-    outfile = "color.png"
+# ----------------------------------------------------------------------
+
+def rgb_composer_arrays(rimage, gimage, bimage, source_r=None, source_g=None, source_b=None, hdrs=(None, None, None), calibs=(None, None, None)):
+    """
+    Same composite as rgb_composer, from three bands that are already in memory
+    (e.g. packed-store views) instead of FITS files. Each band is calibrated from
+    its header in hdrs, or with its precomputed factor in calibs.
+    Returns an (NX, NY, 3) uint8 array.
+    """
+
+    return humvi.compose_mod.compose_arrays(rimage, gimage, bimage, source_r, source_g, source_b, hdrs=hdrs, calibs=calibs, **composer_settings())
+
+# ----------------------------------------------------------------------
+
+def rgb_composer_batch(rimages, gimages, bimages, source_r=None, source_g=None, source_b=None, calibs=(1.0, 1.0, 1.0)):
+    """
+    rgb_composer_arrays for (N,NX,NY) stacks of bands, composed in one vectorised
+    pass. calibs holds one factor, or one factor per image, for each band.
+    Returns an (N,NX,NY,3) uint8 array.
+    """
+
+    return humvi.compose_mod.compose_batch(rimages, gimages, bimages, source_r, source_g, source_b, calibs=calibs, **composer_settings())
+
+# ----------------------------------------------------------------------
+
+def composer_settings():
+
+    vb = False
 
     # Defaults optimized for CFHTLS...
     pars = '1.7,0.09'
@@ -134,8 +164,4 @@ def rgb_composer(rfile, gfile, bfile, source_r, source_g, source_b):
     x, y, z = scales.split(',')
     rscale, gscale, bscale = float(x), float(y), float(z)
 
-    # Compose the image!
-
-    image=humvi.compose_mod(rfile, gfile, bfile, source_r, source_g, source_b, scales=(rscale, gscale, bscale), Q=Q, alpha=alpha, masklevel=masklevel, saturation=saturation, offset=offset, backsub=backsub, vb=vb, outfile=outfile)
-
-    return image
+    return dict(scales=(rscale, gscale, bscale), Q=Q, alpha=alpha, masklevel=masklevel, saturation=saturation, offset=offset, backsub=backsub, vb=vb)
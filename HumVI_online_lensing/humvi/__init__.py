@@ -2,3 +2,4 @@ from .io import *
 from .pjm import *
 from .lupton import *
 from .compose import *
+from . import compose_mod
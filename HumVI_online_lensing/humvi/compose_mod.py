@@ -31,6 +31,94 @@ def compose(rfile, gfile, bfile, source_r, source_g, source_b, scales=(1.0, 1.0,
     band2 = humvi.channel(gfile, source_g)
     band1 = humvi.channel(bfile, source_b)
 
+    r, g, b = compose_channels(band3, band2, band1, scales=scales, Q=Q, alpha=alpha, \
+                               masklevel=masklevel, saturation=saturation, offset=offset, \
+                               backsub=backsub, vb=vb)
+
+    # Package into a python Image, and write out to file:
+    image = humvi.pack_up(r, g, b)
+    #image.save(outfile)
+
+    if vb: print("HumVI: Image saved to:", outfile)
+
+    return image
+
+# ----------------------------------------------------------------------
+
+def compose_arrays(rimage, gimage, bimage, source_r=None, source_g=None, source_b=None, \
+                   hdrs=(None, None, None), calibs=(None, None, None), scales=(1.0, 1.0, 1.0), \
+                   Q=1.0, alpha=1.0, masklevel=None, saturation='color', offset=0.0, \
+                   backsub=False, vb=False):
+    """
+    Compose RGB color image from bands that are already in memory, returned as an
+    (NX, NY, 3) uint8 array. Each band is calibrated from its header in hdrs or, if
+    given, directly with its factor in calibs (see humvi.calibration_factor).
+    """
+
+    band3 = humvi.channel(image=rimage, source_file=source_r, hdr=hdrs[0], calib=calibs[0])
+    band2 = humvi.channel(image=gimage, source_file=source_g, hdr=hdrs[1], calib=calibs[1])
+    band1 = humvi.channel(image=bimage, source_file=source_b, hdr=hdrs[2], calib=calibs[2])
+
+    r, g, b = compose_channels(band3, band2, band1, scales=scales, Q=Q, alpha=alpha, \
+                               masklevel=masklevel, saturation=saturation, offset=offset, \
+                               backsub=backsub, vb=vb)
+
+    return humvi.pack_up_array(r, g, b)
+
+# ----------------------------------------------------------------------
+
+def compose_batch(rimages, gimages, bimages, source_r=None, source_g=None, source_b=None, \
+                  calibs=(1.0, 1.0, 1.0), scales=(1.0, 1.0, 1.0), Q=1.0, alpha=1.0, \
+                  masklevel=None, saturation='color', offset=0.0, backsub=False, vb=False, \
+                  block_size=4):
+    """
+    Compose whole (N,NX,NY) stacks of each band, returned as an (N,NX,NY,3) uint8
+    array equal to composing the images one by one with compose_arrays. calibs
+    holds, per band, one calibration factor for the stack or one per image (see
+    humvi.calibration_factor).
+    The stacks are processed block_size images at a time: every step is vectorised
+    over the block, while the block's temporaries stay small enough to remain in
+    cache - stretching the whole stack at once is memory bound and slower.
+    """
+
+    humvi.check_image_shapes(rimages, gimages, bimages)
+    N = len(rimages)
+    calibs = [numpy.broadcast_to(numpy.asarray(calib, dtype=float), (N,)) for calib in calibs]
+    scales = humvi.normalize_scales(scales)
+    if vb: print('HumVI: Composing a stack of', N, 'images, scales normalized to:', scales)
+
+    packed = numpy.empty(numpy.shape(rimages)+(3,), dtype=numpy.uint8)
+    for start in range(0, N, block_size):
+        block = slice(start, start+block_size)
+        bands = []
+        for images, source, calib, scale in zip((rimages, gimages, bimages), (source_r, source_g, source_b), \
+                                                calibs, scales):
+            # Same precisions as compose_arrays, so that the results are identical
+            if source is not None:
+                image = images[block]+source[block]
+            else:
+                image = numpy.array(images[block], dtype=numpy.result_type(images, numpy.float32))
+            image *= calib[block, None, None].astype(image.dtype)
+            if backsub:
+                image -= numpy.median(image, axis=(-2, -1), keepdims=True)
+            image *= scale
+            bands.append(image)
+
+        r, g, b = stretch_channels(*bands, Q=Q, alpha=alpha, masklevel=masklevel, \
+                                   saturation=saturation, offset=offset)
+        packed[block] = humvi.pack_up_array(r, g, b)
+
+    return packed
+
+# ----------------------------------------------------------------------
+
+def compose_channels(band3, band2, band1, scales=(1.0, 1.0, 1.0), Q=1.0, alpha=1.0, \
+                     masklevel=None, saturation='color', offset=0.0, backsub=False, vb=False):
+    """
+    Scale, stretch, mask, offset and saturate three calibrated channels,
+    returning the r, g, b images ready to be packed up.
+    """
+
     # Check shapes are equal:
     humvi.check_image_shapes(band1.image, band2.image, band3.image)
 
@@ -65,6 +153,18 @@ def compose(rfile, gfile, bfile, source_r, source_g, source_b, scales=(1.0, 1.0,
     green.apply_scale()
     blue.apply_scale()
 
+    return stretch_channels(red.image, green.image, blue.image, Q=Q, alpha=alpha, \
+                            masklevel=masklevel, saturation=saturation, offset=offset, vb=vb)
+
+# ----------------------------------------------------------------------
+
+def stretch_channels(red, green, blue, Q=1.0, alpha=1.0, masklevel=None, saturation='color', \
+                     offset=0.0, vb=False):
+    """
+    Lupton stretch, mask, offset and saturation of three calibrated, scaled
+    images - single images or (N,NX,NY) stacks alike.
+    """
+
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     # Stretch images to cope with high dynamic range:
 
@@ -74,13 +174,13 @@ def compose(rfile, gfile, bfile, source_r, source_g, source_b, scales=(1.0, 1.0,
         print("HumVI: Nonlinearity sets in at about 1/Q*alpha in the scaled intensity image:", 1.0/(Q*alpha))
 
     # Compute total intensity image and the arcsinh of it:
-    I = humvi.lupton_intensity(red.image, green.image, blue.image, type='sum')
+    I = humvi.lupton_intensity(red, green, blue, type='sum')
     stretch = humvi.lupton_stretch(I, Q, alpha)
 
     # Apply stretch to channel images:
-    r = stretch * red.image
-    g = stretch * green.image
-    b = stretch * blue.image
+    r = stretch * red
+    g = stretch * green
+    b = stretch * blue
 
     if masklevel is not None:
         # Mask problem areas - exact zeros or very negative patches should
@@ -93,7 +193,8 @@ def compose(rfile, gfile, bfile, source_r, source_g, source_b, scales=(1.0, 1.0,
 
     # Offset the stretched images to make zero level appear dark gray.
     # Negative offset makes background more black...
-    r, g, b = humvi.pjm_offset(r, g, b, offset)
+    if offset != 0.0:
+        r, g, b = humvi.pjm_offset(r, g, b, offset)
 
     if saturation == 'color':
         # Saturate to colour at some level - might as well be 1, since
@@ -102,12 +203,6 @@ def compose(rfile, gfile, bfile, source_r, source_g, source_b, scales=(1.0, 1.0,
         r, g, b = humvi.lupton_saturate(r, g, b, threshold)
     # Otherwise, saturate to white.
 
-    # Package into a python Image, and write out to file:
-    image = humvi.pack_up(r, g, b)
-    #image.save(outfile)
-
-    if vb: print("HumVI: Image saved to:", outfile)
-
-    return image
+    return r, g, b
 
 # ======================================================================
@@ -22,21 +22,40 @@ vb = 0
 
 class channel:
 
-    def __init__(self, fitsfile, source_file=None):
+    def __init__(self, fitsfile=None, source_file=None, image=None, hdr=None, calib=None):
+        """
+        Reads `fitsfile`, or takes an `image` that is already in memory together with its
+        header `hdr` (a FITS header or a dict) or, in place of the header, its calibration
+        factor `calib`. The input image is never modified.
+        """
 
         self.input = fitsfile
-        # Read in image and header:
-        hdulist = pyfits.open(self.input)
-        # self.hdr = hdulist[0].header
-        # self.image = hdulist[0].data
-        # Picking -1 header assumes we have 1 extension or PS1 (2 ext, image is last)
+        if fitsfile is not None:
+            # Read in image and header:
+            hdulist = pyfits.open(self.input)
+            # self.hdr = hdulist[0].header
+            # self.image = hdulist[0].data
+            # Picking -1 header assumes we have 1 extension or PS1 (2 ext, image is last)
+            if source_file is not None:
+                self.image = hdulist[-1].data+source_file
+            else:
+                self.image = hdulist[-1].data
+            self.hdr = hdulist[-1].header
+            self.calibrate()
+            hdulist.close()
+            return
+
+        # Same precision as reading the image from file: float32 data stays float32
         if source_file is not None:
-			self.image = hdulist[-1].data+source_file
-		else:
-			self.image = hdulist[-1].data
-        self.hdr = hdulist[-1].header
-        self.calibrate()
-        hdulist.close()
+            self.image = image+source_file
+        else:
+            self.image = numpy.array(image, dtype=numpy.result_type(image, numpy.float32))
+        self.hdr = hdr if hdr is not None else {}
+        if calib is None:
+            self.calibrate()
+        else:
+            self.calib = calib
+            self.image *= self.calib
 
         return
 
@@ -202,6 +221,12 @@ class channel:
 
 # ======================================================================
 
+def calibration_factor(hdr):
+    # Factor channel.calibrate applies for an image with header hdr:
+    return channel(image=numpy.zeros((1, 1)), hdr=hdr).calib
+
+# ----------------------------------------------------------------------
+
 def normalize_scales(scales):
     assert len(scales) == 3
     s1, s2, s3 = scales
@@ -242,20 +267,20 @@ def check_image_shapes(r, g, b):
     return
 
 # ----------------------------------------------------------------------
-# Make an 8 bit integer image cube from three channels:
+# Make an 8 bit integer image cube from three channels, or a stack of
+# (N,NX,NY,3) cubes from three (N,NX,NY) stacks of channels:
 
-def pack_up(r, g, b):
+def pack_up_array(r, g, b):
 
-    NX, NY = numpy.shape(r)
+    x = numpy.empty(numpy.shape(r)+(3,), dtype=numpy.uint8)
+    for k, channel in enumerate((r, g, b)):
+        # Flip up-down, clip to [0,1] and cast each channel straight into the cube:
+        x[..., k] = numpy.clip(channel[..., ::-1, :], 0.0, 1.0)*255
 
-    x = numpy.zeros([NX, NY, 3])
-    x[:,:, 0] = numpy.flipud(r)
-    x[:,:, 1] = numpy.flipud(g)
-    x[:,:, 2] = numpy.flipud(b)
+    return x
 
-    x = numpy.clip(x, 0.0, 1.0)
-    x = x*255
+def pack_up(r, g, b):
 
-    return Image.fromarray(x.astype(numpy.uint8))
+    return Image.fromarray(pack_up_array(r, g, b))
 
 # ======================================================================
@@ -6,6 +6,9 @@ Lupton et al algorithm for making color composite images.
 
 Phil Marshall, Winter 2013
 
+All functions work elementwise, on single (NX,NY) images or on
+(N,NX,NY) stacks of images alike.
+
 """
 
 # ======================================================================
@@ -35,10 +38,8 @@ def lupton_stretch(I, Q, alpha):
 
 def lupton_saturate(r, g, b, threshold):
 
-    x = numpy.dstack((r, g, b))
-
     # Highest pixel-value at given position
-    maxpix = numpy.max(x, axis=-1)
+    maxpix = numpy.maximum(numpy.maximum(r, g), b)
     maxpix[maxpix<1.0] = 1.0
 
     rr = r/maxpix
@@ -2,7 +2,8 @@
 
 """
 Functions for implementing Phil's tweaks to the Lupton algorithm for
-making color composite images.
+making color composite images. Like the Lupton functions, they work
+on single images or (N,NX,NY) stacks alike.
 """
 
 # ======================================================================
@@ -3,33 +3,38 @@ Generator that augments data in realtime
 """
 
 import numpy as np
+from PIL import Image
 import skimage
+import skimage.transform
 import multiprocessing as mp
+import contextlib
+import collections
 import time
 import glob
-import load_data_custom as load_data
+from concurrent.futures import ThreadPoolExecutor
+import load_data
+from load_data import stretches, stretch_chunk
+import packed_store
+import random_streams
 
 ###########Parameters
 
 test_path='data/test_data/'
-test_data=glob.glob(test_path+'*_r_*.fits')
-num_test=len(test_data)
 
 ###########
 
 loadsize=100  
-NUM_PROCESSES = 2 
+NUM_PROCESSES = 2   # default worker count, override with num_processes in the generators
+IO_THREADS = 4      # threads reading test cutouts from disk
+IO_DEPTH = 8        # batches of test cutouts read ahead of the process pool
+PROCESS_DEPTH = 4   # batches of test cutouts in flight in the process pool
 
 
 CHUNK_SIZE = 25000
 IMAGE_WIDTH = 101
 IMAGE_HEIGHT = 101             
 IMAGE_NUM_CHANNELS = 3
-
-num_sources=load_data.num_sources
-num_lenses=load_data.num_lenses
-num_neg=load_data.num_neg
-num_real_lenses=load_data.num_real_lenses
+CHUNK_DTYPE = 'uint8'   # training chunks hold 0-255 images, the model rescales them (see cnn.build_resnet)
 
 default_augmentation_params = {
     'zoom_range': (1.0, 1.0),
@@ -40,29 +45,126 @@ default_augmentation_params = {
 
 ## UTILITIES ##
 
-def select_indices(num, num_selected):                      
+_test_data = {}
+
+def get_test_data(test_path=test_path):
+    """r-band test cutouts in `test_path`, globbed on first use rather than at import."""
+    if test_path not in _test_data:
+        _test_data[test_path] = glob.glob(test_path+'*_r_*.fits')
+    return _test_data[test_path]
+
+@contextlib.contextmanager
+def pool_scope(pool=None, num_processes=None):
+    """
+    Yields `pool` if one is passed in (the caller owns it), otherwise a new pool of
+    num_processes workers that lives as long as the with-block: it is closed and joined
+    when the block finishes, and terminated if it is abandoned (e.g. a generator closed
+    half-way through a chunk).
+    """
+    if pool is not None:
+        yield pool
+        return
+    pool = mp.Pool(num_processes or NUM_PROCESSES)
+    try:
+        yield pool
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+def read_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+def prefetch_files(batches, files_of, io_threads=IO_THREADS, depth=IO_DEPTH):
+    """
+    Yields (batch, files) for every batch of paths, where files maps each of the file names
+    files_of(path) of the batch to its contents, read by a pool of io_threads threads.
+    At most `depth` batches are read ahead of the consumer.
+    """
+    with ThreadPoolExecutor(io_threads) as executor:
+        pending = collections.deque()
+        for batch in batches:
+            names = [name for path in batch for name in files_of(path)]
+            pending.append((batch, names, [executor.submit(read_file, name) for name in names]))
+            if len(pending) >= depth:
+                yield _collect_files(*pending.popleft())
+        while pending:
+            yield _collect_files(*pending.popleft())
+
+def _collect_files(batch, names, futures):
+    return batch, dict(zip(names, [future.result() for future in futures]))
+
+def bounded_imap(pool, func, iterable, depth=PROCESS_DEPTH):
+    """
+    Ordered pool.imap that keeps at most `depth` tasks in flight. Pool.imap consumes its
+    input as fast as it can, which for prefetch_files would mean reading every file ahead.
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= depth:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def test_files(path):
+    return [path]
+
+def test_files_col(path):
+    return [path] + [packed_store.band_name(path, band) for band in ('g', 'i')]
+
+def select_indices(num, num_selected, rng=None):                      
+    if rng is None:
+        rng = np.random.default_rng()
     selected_indices = np.arange(num)
-    np.random.shuffle(selected_indices)
+    rng.shuffle(selected_indices)
     selected_indices = selected_indices[:num_selected]
     return selected_indices
 
+def batches(items, batch_size=loadsize):
+    """Splits `items` into consecutive batches of at most batch_size, one pool task each."""
+    return [items[i:i+batch_size] for i in range(0, len(items), batch_size)]
+
     
+def to_chunk_dtype(imgs):
+    """0-255 float images rounded to CHUNK_DTYPE, in place as far as possible; interpolation overshoot is clipped."""
+    imgs = np.asarray(imgs)
+    np.rint(imgs, out=imgs)
+    np.clip(imgs, 0, 255, out=imgs)
+    return imgs.astype(CHUNK_DTYPE)
+
+def warp_batch(imgs, matrices, output_shape=(53,53), mode='reflect'):
+    """
+    Bilinear affine warp of a (N,H,W,C) stack into one preallocated float32 array.
+    matrices are (N,3,3), or a single 3x3 shared by the stack, and map output (col, row)
+    coordinates to input coordinates like the `params` of a skimage transform.
+    Each image goes through skimage's compiled warp once for all of its channels (a pure
+    NumPy gather over the whole stack measured 2-3x slower on 101x101x3 cutouts).
+    """
+    imgs = np.asarray(imgs, dtype='float32')
+    matrices = np.broadcast_to(np.asarray(matrices, dtype='float64'), (len(imgs), 3, 3))
+    warped = np.empty((len(imgs), output_shape[0], output_shape[1]) + imgs.shape[3:], dtype='float32')
+    for i in range(len(imgs)):
+        warped[i] = skimage.transform.warp(imgs[i], matrices[i], output_shape=output_shape, order=1, mode=mode, preserve_range=True, clip=False)
+    return warped
+
 def fast_warp(img, tf, output_shape=(53,53), mode='reflect'):             
     """
-    This wrapper function is about five times faster than skimage.transform.warp, for our use case.
+    Warps a single (H,W,C) image with the skimage transform `tf`, see warp_batch.
     """
-    m = tf.params   
-    img_wf = np.empty((output_shape[0], output_shape[1], IMAGE_NUM_CHANNELS), dtype='float32')
-    for k in range(IMAGE_NUM_CHANNELS):
-        img_wf[..., k] = skimage.transform._warps_cy._warp_fast(img[..., k], m, output_shape=output_shape, mode=mode)
-    return img_wf
+    return warp_batch(img[None], tf.params, output_shape=output_shape, mode=mode)[0]
 
 ## TRANSFORMATIONS ##
 
 def build_augmentation_transform(zoom=1.0, rotation=0, shear=0, translation=(0, 0)):                
-    tform_augment = skimage.transform.AffineTransform(scale=(1/zoom, 1/zoom), rotation=np.deg2rad(rotation), shear=np.deg2rad(shear), translation=translation)
-    tform = tform_center + tform_augment + tform_uncenter 
-    return tform
+    # the matrix of augmentation_matrices, as the batched generators use it: skimage's own
+    # shear convention differs between versions (some ignore a 180 degree shear, i.e. the flip)
+    matrix = augmentation_matrices([zoom], [rotation], [shear], [translation])[0]
+    return skimage.transform.AffineTransform(matrix=matrix)
 
 def build_ds_transform(ds_factor=1.0, orig_size=(101, 101), target_size=(53, 53), do_shift=True, subpixel_shift=False):
     """
@@ -99,146 +201,284 @@ ds_transforms_default = [tform_identity]
 ds_transforms = ds_transforms_default # CHANGE THIS LINE to select downsampling transforms to be used
 
 
-def random_perturbation_transform(zoom_range, rotation_range, shear_range, translation_range, do_flip=False):   
+def random_perturbation_transform(zoom_range, rotation_range, shear_range, translation_range, do_flip=False, rng=None):   
+    if rng is None:
+        rng = np.random.default_rng()
     
-    shift_x = np.random.uniform(*translation_range)
-    shift_y = np.random.uniform(*translation_range)
+    shift_x = rng.uniform(*translation_range)
+    shift_y = rng.uniform(*translation_range)
     translation = (shift_x, shift_y)
 
     # random rotation [0, 360]
-    rotation = np.random.uniform(*rotation_range) # there is no post-augmentation, so full rotations here!
+    rotation = rng.uniform(*rotation_range) # there is no post-augmentation, so full rotations here!
 
     # random shear [0, 5]
-    shear = np.random.uniform(*shear_range)
+    shear = rng.uniform(*shear_range)
 
     # # flip
-    if do_flip and (np.random.randint(2) > 0): # flip half of the time
+    if do_flip and (rng.integers(2) > 0): # flip half of the time
         shear += 180
         rotation += 180
 
     log_zoom_range = [np.log(z) for z in zoom_range]
-    zoom = np.exp(np.random.uniform(*log_zoom_range)) # for a zoom factor this sampling approach makes more sense.
+    zoom = np.exp(rng.uniform(*log_zoom_range)) # for a zoom factor this sampling approach makes more sense.
     # the range should be multiplicatively symmetric, so [1/1.1, 1.1] instead of [0.9, 1.1] makes more sense.
 
     return build_augmentation_transform(zoom, rotation, shear, translation)
 
+def augmentation_matrices(zoom, rotation, shear, translation):
+    """
+    Vectorised build_augmentation_transform: arrays of n zooms, rotations and shears (degrees)
+    and (n,2) translations give the n (3,3) matrices of the centred affine transforms.
+    """
+    zoom = np.asarray(zoom, dtype='float64')
+    rotation = np.deg2rad(rotation)
+    shear = np.deg2rad(shear)
+    scale = 1 / zoom
+    augment = np.zeros((len(zoom), 3, 3))
+    augment[:, 0, 0] = scale * np.cos(rotation)
+    augment[:, 0, 1] = -scale * np.sin(rotation + shear)
+    augment[:, 1, 0] = scale * np.sin(rotation)
+    augment[:, 1, 1] = scale * np.cos(rotation + shear)
+    augment[:, :2, 2] = translation
+    augment[:, 2, 2] = 1
+    return np.matmul(np.matmul(tform_uncenter.params, augment), tform_center.params)
+
+def random_perturbation_matrices(n, zoom_range, rotation_range, shear_range, translation_range, do_flip=False, rng=None):
+    """
+    n random augmentation matrices, drawn from the same distribution as random_perturbation_transform.
+    rng is one np.random.Generator for all of them, or a list of n generators, one per matrix.
+    """
+    if isinstance(rng, (list, tuple)):
+        return np.concatenate([random_perturbation_matrices(1, zoom_range, rotation_range, shear_range, translation_range, do_flip, r)
+                               for r in rng]) if rng else np.zeros((0, 3, 3))
+    if rng is None:
+        rng = np.random.default_rng()
+    translation = rng.uniform(*translation_range, size=(n, 2))
+    rotation = rng.uniform(*rotation_range, size=n)
+    shear = rng.uniform(*shear_range, size=n)
+    if do_flip:
+        flip = 180 * rng.integers(2, size=n)
+        shear = shear + flip
+        rotation = rotation + flip
+    log_zoom_range = [np.log(z) for z in zoom_range]
+    zoom = np.exp(rng.uniform(*log_zoom_range, size=n))
+    return augmentation_matrices(zoom, rotation, shear, translation)
 
-def perturb_and_dscrop(img, ds_transforms, augmentation_params, target_sizes=None):  
+
+def perturb_and_dscrop(img, ds_transforms, augmentation_params, target_sizes=None, rng=None):  
+    return [imgs[0] for imgs in perturb_and_dscrop_batch(img[None], ds_transforms, augmentation_params, target_sizes, rng)]
+
+def perturb_and_dscrop_batch(imgs, ds_transforms, augmentation_params, target_sizes=None, rng=None):
+    """
+    perturb_and_dscrop for a (N,H,W,C) stack: one random augmentation per image,
+    returns one float32 stack per ds transform. rng as in random_perturbation_matrices.
+    """
     if target_sizes is None: 
         target_sizes = [(53, 53) for _ in range(len(ds_transforms))]
 
-    tform_augment = random_perturbation_transform(**augmentation_params)
+    augment = random_perturbation_matrices(len(imgs), rng=rng, **augmentation_params)
 
     result = []
     for tform_ds, target_size in zip(ds_transforms, target_sizes):
-        result.append(fast_warp(img, tform_ds + tform_augment, output_shape=target_size, mode='reflect').astype('float32'))   #crop here?
+        # tform_ds + tform_augment: the ds transform is applied first
+        result.append(warp_batch(imgs, np.matmul(augment, tform_ds.params), output_shape=target_size, mode='reflect'))   #crop here?
 
     return result
 
 ## REALTIME AUGMENTATION GENERATOR ##
 
-def load_and_process_image_source(img_index, ds_transforms, augmentation_params, target_sizes=None):  ##USATA
+def load_and_process_image_source(img_index, ds_transforms, augmentation_params, target_sizes=None, rng=None):  ##USATA
     img_id = load_data.train_ids_source[img_index]
     img = load_data.load_fits_source(img_id)
     img= np.dstack((img,img,img))
-    img_a = perturb_and_dscrop(img, ds_transforms, augmentation_params, target_sizes)
+    img_a = perturb_and_dscrop(img, ds_transforms, augmentation_params, target_sizes, rng)
     return img_a
     
-def load_and_process_image_lens(img_index, ds_transforms, augmentation_params, target_sizes=None):  ##USATA
+def load_and_process_image_lens(img_index, ds_transforms, augmentation_params, target_sizes=None, rng=None):  ##USATA
     img_id = load_data.train_ids_lens[img_index]
     img = load_data.load_fits_lens(img_id)
     img= np.dstack((img,img,img))
-    img_a = perturb_and_dscrop(img, ds_transforms, augmentation_params, target_sizes)
+    img_a = perturb_and_dscrop(img, ds_transforms, augmentation_params, target_sizes, rng)
     return img_a
 
-def load_and_process_image_neg(img_index, ds_transforms, augmentation_params, target_sizes=None):  ##USATA
+def load_and_process_image_neg(img_index, ds_transforms, augmentation_params, target_sizes=None, rng=None):  ##USATA
     img_id = load_data.train_ids_neg[img_index]
     img = load_data.load_fits_neg(img_id)
     img= np.dstack((img,img,img))
-    img_a = perturb_and_dscrop(img, ds_transforms, augmentation_params, target_sizes)
+    img_a = perturb_and_dscrop(img, ds_transforms, augmentation_params, target_sizes, rng)
     return img_a
 
-def load_and_process_image_fixed_test(img_index, ds_transforms, augmentation_transforms, target_sizes=None):
-    img_id = test_data[img_index]
-    img = load_data.load_fits_test(img_id)
+def load_and_process_image_pos(task, ds_transforms, augmentation_params, target_sizes=None, rngs=(None, None), normalize=True, resize=False, resize_shape=(60,60), stretch='sqrt'):
+    """
+    A single-band positive: the augmented source (rngs[0]) added to the augmented lens
+    (rngs[1]) at `strength` times the lens peak, then stretched like the negatives
+    (and, normalised, as CHUNK_DTYPE).
+    """
+    source_index, lens_index, strength = task
+    sources = load_and_process_image_source(source_index, ds_transforms, augmentation_params, target_sizes, rngs[0])
+    lenses = load_and_process_image_lens(lens_index, ds_transforms, augmentation_params, target_sizes, rngs[1])
+    imgs = []
+    for source, lens in zip(sources, lenses):
+        imageData = lens+source/np.amax(source)*np.amax(lens)*strength
+        new_img = stretch_chunk(imageData[None], stretch, normalize)[0]
+        if resize:
+            new_img = resize_image(new_img, resize_shape)
+        imgs.append(to_chunk_dtype(new_img) if normalize else new_img)
+    return imgs
+
+def resize_image(img, resize_shape=(60,60)):
+    new_img=Image.fromarray(img)
+    return new_img.resize(resize_shape, resample=Image.LANCZOS)
+
+def load_and_process_image_fixed_test(img_path, ds_transforms, augmentation_transforms, target_sizes=None, stretch='sqrt'):
+    img = load_data.load_fits_test(img_path, stretch=stretch)
     img= np.dstack((img,img,img))
     return [img]
 
-def load_and_process_image_neg_col(img_index, ds_transforms, augmentation_params, target_sizes=None):  ##USATA
+def load_and_process_image_neg_col(img_index, ds_transforms, augmentation_params, target_sizes=None, rng=None):  ##USATA
     img_id = load_data.train_ids_neg[img_index]
     img = load_data.load_fits_neg_col(img_id)
-    img_a = perturb_and_dscrop(img, ds_transforms, augmentation_params, target_sizes)
-    return img_a
+    img_a = perturb_and_dscrop(img, ds_transforms, augmentation_params, target_sizes, rng)
+    return [to_chunk_dtype(img) for img in img_a]
     
-def load_and_process_image_pos_col(img_index, ds_transforms, augmentation_params, target_sizes=None):  
+def load_and_process_image_pos_col(img_index, ds_transforms, augmentation_params, target_sizes=None, rng=None):  
     img_id_lens = load_data.train_ids_lens[img_index[0]]
     img_id_src = load_data.train_ids_source[img_index[1]]
-    img = load_data.load_fits_pos_col(img_id_lens,img_id_src)
-    img_a = perturb_and_dscrop(img, ds_transforms, augmentation_params, target_sizes)
-    return img_a
-
-def load_and_process_image_fixed_test_col(img_index, ds_transforms, augmentation_transforms, target_sizes=None):
-    img_id = test_data[img_index]
-    img = load_data.load_fits_test_col(img_id)
+    img = load_data.load_fits_pos_col(img_id_lens,img_id_src,rng=rng)
+    img_a = perturb_and_dscrop(img, ds_transforms, augmentation_params, target_sizes, rng)
+    return [to_chunk_dtype(img) for img in img_a]
+
+def load_and_process_image_pos_col_batch(img_indices, ds_transforms, augmentation_params, target_sizes=None, rngs=None):
+    """rngs: one generator per sample, used for its mock lens and then for its augmentation."""
+    img_indices = np.asarray(img_indices)
+    img_ids_lens = load_data.train_ids_lens[img_indices[:, 0]]
+    img_ids_src = load_data.train_ids_source[img_indices[:, 1]]
+    imgs = load_data.load_fits_pos_col_batch(img_ids_lens, img_ids_src, rngs=rngs)
+    return [to_chunk_dtype(imgs_a) for imgs_a in perturb_and_dscrop_batch(imgs, ds_transforms, augmentation_params, target_sizes, rngs)]
+
+def load_and_process_image_fixed_test_col(img_path, ds_transforms, augmentation_transforms, target_sizes=None):
+    img = load_data.load_fits_test_col(img_path)
     return [img]
 
+def load_and_process_image_fixed_test_batch(img_paths, ds_transforms, augmentation_transforms, target_sizes=None, files=None, stretch='sqrt'):
+    imgs = [load_and_process_image_fixed_test(load_data.in_memory(img_path, files), ds_transforms, augmentation_transforms, target_sizes, stretch)[0]
+            for img_path in img_paths]
+    return [np.stack(imgs)]
+
+def load_and_process_image_fixed_test_col_batch(img_paths, ds_transforms, augmentation_transforms, target_sizes=None, files=None):
+    imgs = load_data.load_fits_test_col_batch(img_paths, files=files)
+    return [imgs]
+
 class LoadAndProcessNeg(object):                                                       ##USATA
 
-    def __init__(self, ds_transforms, augmentation_params, target_sizes=None):
+    def __init__(self, ds_transforms, augmentation_params, target_sizes=None, streams=None):
         self.ds_transforms = ds_transforms
         self.augmentation_params = augmentation_params
         self.target_sizes = target_sizes
+        self.streams = streams
 
-    def __call__(self, img_index):
-        return load_and_process_image_neg(img_index, self.ds_transforms, self.augmentation_params, self.target_sizes)
+    def __call__(self, task):
+        key, img_index = task
+        return load_and_process_image_neg(img_index, self.ds_transforms, self.augmentation_params, self.target_sizes,
+                                          random_streams.generator(self.streams, key))
 
         
 class LoadAndProcessLens(object):                                                       ##USATA
 
-    def __init__(self, ds_transforms, augmentation_params, target_sizes=None):
+    def __init__(self, ds_transforms, augmentation_params, target_sizes=None, streams=None):
         self.ds_transforms = ds_transforms
         self.augmentation_params = augmentation_params
         self.target_sizes = target_sizes
+        self.streams = streams
 
-    def __call__(self, img_index):
-        return load_and_process_image_lens(img_index, self.ds_transforms, self.augmentation_params, self.target_sizes)
+    def __call__(self, task):
+        key, img_index = task
+        return load_and_process_image_lens(img_index, self.ds_transforms, self.augmentation_params, self.target_sizes,
+                                          random_streams.generator(self.streams, key))
 
 class LoadAndProcessSource(object):                                                       ##USATA
 
-    def __init__(self, ds_transforms, augmentation_params, target_sizes=None):
+    def __init__(self, ds_transforms, augmentation_params, target_sizes=None, streams=None):
         self.ds_transforms = ds_transforms
         self.augmentation_params = augmentation_params
         self.target_sizes = target_sizes
+        self.streams = streams
 
-    def __call__(self, img_index):
-        return load_and_process_image_source(img_index, self.ds_transforms, self.augmentation_params, self.target_sizes)
+    def __call__(self, task):
+        key, img_index = task
+        return load_and_process_image_source(img_index, self.ds_transforms, self.augmentation_params, self.target_sizes,
+                                          random_streams.generator(self.streams, key))
     
+class LoadAndProcessPos(object):
+    """Makes a finished single-band positive per task, see load_and_process_image_pos."""
+
+    def __init__(self, ds_transforms, augmentation_params, target_sizes=None, streams=None, normalize=True, resize=False, resize_shape=(60,60), stretch='sqrt'):
+        self.ds_transforms = ds_transforms
+        self.augmentation_params = augmentation_params
+        self.target_sizes = target_sizes
+        self.streams = streams
+        self.normalize = normalize
+        self.resize = resize
+        self.resize_shape = resize_shape
+        self.stretch = stretch
+
+    def __call__(self, task):
+        key, indices = task
+        # the source and the lens keep separate streams
+        rngs = [random_streams.generator(self.streams, key + (part,)) for part in (0, 1)]
+        return load_and_process_image_pos(indices, self.ds_transforms, self.augmentation_params, self.target_sizes, rngs,
+                                          self.normalize, self.resize, self.resize_shape, self.stretch)
+
 class LoadAndProcessFixedTest(object):
-    def __init__(self, ds_transforms, augmentation_transforms, target_sizes=None):
+    def __init__(self, ds_transforms, augmentation_transforms, target_sizes=None, stretch='sqrt'):
         self.ds_transforms = ds_transforms
         self.augmentation_transforms = augmentation_transforms
         self.target_sizes = target_sizes
+        self.stretch = stretch
+
+    def __call__(self, img_path):
+        return load_and_process_image_fixed_test(img_path, self.ds_transforms, self.augmentation_transforms, self.target_sizes, self.stretch)
 
-    def __call__(self, img_index):
-        return load_and_process_image_fixed_test(img_index, self.ds_transforms, self.augmentation_transforms, self.target_sizes)
+class LoadAndProcessFixedTestBatch(LoadAndProcessFixedTest):
+    """LoadAndProcessFixedTest over a (paths, files) batch from prefetch_files."""
+    files_of = staticmethod(test_files)
+
+    def __call__(self, batch):
+        img_paths, files = batch
+        return load_and_process_image_fixed_test_batch(img_paths, self.ds_transforms, self.augmentation_transforms, self.target_sizes, files, self.stretch)
 
 class LoadAndProcessNegCol(object):  
-    def __init__(self, ds_transforms, augmentation_params, target_sizes=None):
+    def __init__(self, ds_transforms, augmentation_params, target_sizes=None, streams=None):
         self.ds_transforms = ds_transforms
         self.augmentation_params = augmentation_params
         self.target_sizes = target_sizes
+        self.streams = streams
 
-    def __call__(self, img_index):
-        return load_and_process_image_neg_col(img_index, self.ds_transforms, self.augmentation_params, self.target_sizes)
+    def __call__(self, task):
+        key, img_index = task
+        return load_and_process_image_neg_col(img_index, self.ds_transforms, self.augmentation_params, self.target_sizes,
+                                          random_streams.generator(self.streams, key))
 
 class LoadAndProcessPosCol(object):
-    def __init__(self, ds_transforms, augmentation_params, target_sizes=None):
+    def __init__(self, ds_transforms, augmentation_params, target_sizes=None, streams=None):
         self.ds_transforms = ds_transforms
         self.augmentation_params = augmentation_params
         self.target_sizes = target_sizes
+        self.streams = streams
+
+    def __call__(self, task):
+        key, img_index = task
+        return load_and_process_image_pos_col(img_index, self.ds_transforms, self.augmentation_params, self.target_sizes,
+                                          random_streams.generator(self.streams, key))
 
-    def __call__(self, img_index):
-        return load_and_process_image_pos_col(img_index, self.ds_transforms, self.augmentation_params, self.target_sizes)
+class LoadAndProcessPosColBatch(LoadAndProcessPosCol):
+    """LoadAndProcessPosCol over a batch of tasks, composed and warped as one stack."""
+
+    def __call__(self, tasks):
+        keys, img_indices = zip(*tasks)
+        return load_and_process_image_pos_col_batch(img_indices, self.ds_transforms, self.augmentation_params, self.target_sizes,
+                                                    [random_streams.generator(self.streams, key) for key in keys])
 
 
           
@@ -248,246 +488,249 @@ class LoadAndProcessFixedTestCol(object):
         self.augmentation_transforms = augmentation_transforms
         self.target_sizes = target_sizes
 
-    def __call__(self, img_index):
-        return load_and_process_image_fixed_test_col(img_index, self.ds_transforms, self.augmentation_transforms, self.target_sizes)
+    def __call__(self, img_path):
+        return load_and_process_image_fixed_test_col(img_path, self.ds_transforms, self.augmentation_transforms, self.target_sizes)
+
+class LoadAndProcessFixedTestColBatch(LoadAndProcessFixedTestCol):
+    """LoadAndProcessFixedTestCol over a (paths, files) batch from prefetch_files, composed as one stack."""
+    files_of = staticmethod(test_files_col)
+
+    def __call__(self, batch):
+        img_paths, files = batch
+        return load_and_process_image_fixed_test_col_batch(img_paths, self.ds_transforms, self.augmentation_transforms, self.target_sizes, files)
 
         
       
 def realtime_augmented_data_gen_neg(num_chunks=None,chunk_size=CHUNK_SIZE, augmentation_params=default_augmentation_params,          #keep
-                                ds_transforms=ds_transforms_default, target_sizes=None, processor_class=LoadAndProcessNeg, normalize=True, resize= False, resize_shape=(60,60)):
+                                ds_transforms=ds_transforms_default, target_sizes=None, processor_class=LoadAndProcessNeg, normalize=True, resize= False, resize_shape=(60,60), pool=None, num_processes=None, seed=None, stretch='sqrt'):
     """
     new version, using Pool.imap instead of Pool.map, to avoid the data structure conversion
     from lists to numpy arrays afterwards.
+    All the random draws come from random_streams seeded with `seed`, so a seed fixes the chunks.
+    Each finished chunk is stretched (see stretch_chunk) in one vectorised pass.
     """
 
     if target_sizes is None: 
         target_sizes = [(53, 53) for _ in range(len(ds_transforms))]
-    n = 0 
-    while True:
-        if num_chunks is not None and n >= num_chunks:
-            break
-        selected_indices = select_indices(num_neg, chunk_size)
-        labels = np.zeros(chunk_size)
-        process_func = processor_class(ds_transforms, augmentation_params, target_sizes)    
+    streams = random_streams.RandomStreams(seed)
+    with pool_scope(pool, num_processes) as pool:
+        n = 0 
+        while True:
+            if num_chunks is not None and n >= num_chunks:
+                break
+            selected_indices = select_indices(load_data.num_neg, chunk_size, streams.generator(random_streams.NEG, n))
+            tasks = [((random_streams.NEG, n, k), index) for k, index in enumerate(selected_indices)]
+            labels = np.zeros(chunk_size)
+            process_func = processor_class(ds_transforms, augmentation_params, target_sizes, streams=streams)    
         
-        target_arrays = [np.empty((chunk_size, size_x, size_y, IMAGE_NUM_CHANNELS), dtype='float32') for size_x, size_y in target_sizes]
-        pool = mp.Pool(NUM_PROCESSES)
-        gen = pool.imap(process_func, selected_indices, chunksize=loadsize) # lower chunksize seems to help to keep memory usage in check
+            target_arrays = [np.empty((chunk_size, size_x, size_y, IMAGE_NUM_CHANNELS), dtype='float32') for size_x, size_y in target_sizes]
+            gen = pool.imap(process_func, tasks, chunksize=loadsize) # lower chunksize seems to help to keep memory usage in check
         
-        for k, imgs in enumerate(gen):
-            for i, image in enumerate(imgs):
-              scale_min = 0
-              scale_max = image.max()
-              image.clip(min=scale_min, max=scale_max)
-              indices = np.where(image < 0)
-              image[indices] = 0.0
-              new_img = np.sqrt(image)
-              if normalize:
-                new_img = (new_img / new_img.max()*255.) 
-              if resize:
-                new_img=Image.fromarray(new_img)
-                new_img=new_img.resize(resize_shape, resample=Image.LANCZOS)
-              target_arrays[i][k] = new_img
-        pool.close()
-        pool.join()
+            for k, imgs in enumerate(gen):
+                for i, image in enumerate(imgs):
+                  target_arrays[i][k] = image
+            for i, target in enumerate(target_arrays):
+                stretch_chunk(target, stretch, normalize)
+                if resize:
+                  for k in range(chunk_size):
+                    target[k] = resize_image(target[k], resize_shape)
+                if normalize:
+                  target_arrays[i] = to_chunk_dtype(target)
         
-        target_arrays.append(labels.astype(np.int32))
+            target_arrays.append(labels.astype(np.int32))
         
-        yield target_arrays, chunk_size
-        n += 1
+            yield target_arrays, chunk_size
+            n += 1
         
         
 def realtime_augmented_data_gen_pos(num_chunks=None,chunk_size=CHUNK_SIZE, augmentation_params=default_augmentation_params,          #keep
-                                ds_transforms=ds_transforms_default, target_sizes=None, processor_class=LoadAndProcessSource, processor_class2=LoadAndProcessLens, normalize=True, resize=False, resize_shape=(60,60), range_min=0.02, range_max=0.5):
+                                ds_transforms=ds_transforms_default, target_sizes=None, processor_class=LoadAndProcessPos, normalize=True, resize=False, resize_shape=(60,60), range_min=0.02, range_max=0.5, pool=None, num_processes=None, seed=None, stretch='sqrt'):
     """
     new version, using Pool.imap instead of Pool.map, to avoid the data structure conversion
     from lists to numpy arrays afterwards.
+    Each pool task makes one finished positive (see load_and_process_image_pos), so only
+    the stretched image (see stretch_chunk) comes back from the workers.
+    All the random draws come from random_streams seeded with `seed`, so a seed fixes the chunks.
     """
     if target_sizes is None:
         target_sizes = [(53, 53) for _ in range(len(ds_transforms))]
-    n = 0 
-    while True:
-        if num_chunks is not None and n >= num_chunks:
-            break        
-        selected_indices_sources = select_indices(num_sources, chunk_size)    
-        selected_indices_lenses = select_indices(num_lenses, chunk_size)
+    streams = random_streams.RandomStreams(seed)
+    with pool_scope(pool, num_processes) as pool:
+        n = 0 
+        while True:
+            if num_chunks is not None and n >= num_chunks:
+                break        
+            chunk_rng = streams.generator(random_streams.POS, n)
+            selected_indices_sources = select_indices(load_data.num_sources, chunk_size, chunk_rng)    
+            selected_indices_lenses = select_indices(load_data.num_lenses, chunk_size, chunk_rng)
+            strengths = chunk_rng.uniform(range_min, range_max, size=chunk_size)
         
-        labels = np.ones(chunk_size)
+            labels = np.ones(chunk_size)
         
-        process_func = processor_class(ds_transforms, augmentation_params, target_sizes)    #SOURCE
-        process_func2 = processor_class2(ds_transforms, augmentation_params, target_sizes)     #LENS
+            process_func = processor_class(ds_transforms, augmentation_params, target_sizes, streams=streams, normalize=normalize, resize=resize, resize_shape=resize_shape, stretch=stretch)
         
-        target_arrays_pos = [np.empty((chunk_size, size_x, size_y, IMAGE_NUM_CHANNELS), dtype='float32') for size_x, size_y in target_sizes]
+            target_arrays_pos = [np.empty((chunk_size, size_x, size_y, IMAGE_NUM_CHANNELS), dtype=CHUNK_DTYPE if normalize else 'float32') for size_x, size_y in target_sizes]
         
-        pool1 = mp.Pool(NUM_PROCESSES)
-        gen = pool1.imap(process_func, selected_indices_sources, chunksize=loadsize) 
+            tasks = [((random_streams.POS, n, k), indices) for k, indices in enumerate(zip(selected_indices_sources, selected_indices_lenses, strengths))]
+            gen = pool.imap(process_func, tasks, chunksize=loadsize) 
         
-        pool2 = mp.Pool(NUM_PROCESSES)
-        gen2 = pool2.imap(process_func2, selected_indices_lenses, chunksize=loadsize) 
+            for k, imgs in enumerate(gen):
+                for i, image in enumerate(imgs):
+                  target_arrays_pos[i][k] = image
         
-        k=0
-        for source,lens in zip(gen,gen2):
-          source=np.array(source)
-          lens=np.array(lens)
-          imageData=lens+source/np.amax(source)*np.amax(lens)*np.random.uniform(range_min,range_max)
-          scale_min = 0
-          scale_max = imageData.max()
-          imageData.clip(min=scale_min, max=scale_max)
-          indices = np.where(imageData < 0)
-          imageData[indices] = 0.0
-          new_img = np.sqrt(imageData)
-          if normalize:
-            new_img =  (new_img / new_img.max()*255.) 
-          if resize:
-              new_img=Image.fromarray(new_img)
-              new_img=new_img.resize(resize_shape, resample=Image.LANCZOS)
-          target_arrays_pos[0][k] = new_img
-          k+=1
+            target_arrays_pos.append(labels.astype(np.int32))
         
-        pool1.close()
-        pool1.join()
-        pool2.close()
-        pool2.join()
-        target_arrays_pos.append(labels.astype(np.int32))
-        
-        yield target_arrays_pos, chunk_size
-        n += 1
+            yield target_arrays_pos, chunk_size
+            n += 1
 
 
         
 def realtime_augmented_data_gen_neg_col(num_chunks=None,chunk_size=CHUNK_SIZE, augmentation_params=default_augmentation_params,          #keep
-                                ds_transforms=ds_transforms_default, target_sizes=None, processor_class=LoadAndProcessNegCol):
+                                ds_transforms=ds_transforms_default, target_sizes=None, processor_class=LoadAndProcessNegCol, pool=None, num_processes=None, seed=None):
     """
     new version, using Pool.imap instead of Pool.map, to avoid the data structure conversion
     from lists to numpy arrays afterwards.
+    All the random draws come from random_streams seeded with `seed`, so a seed fixes the chunks.
     """
 
     if target_sizes is None: 
         target_sizes = [(53, 53) for _ in range(len(ds_transforms))]
-    n = 0 
-    while True:
-        if num_chunks is not None and n >= num_chunks:
+    streams = random_streams.RandomStreams(seed)
+    with pool_scope(pool, num_processes) as pool:
+        n = 0 
+        while True:
+            if num_chunks is not None and n >= num_chunks:
             
-            break
-        selected_indices = select_indices(num_neg, chunk_size)
-        labels = np.zeros(chunk_size)
-        process_func = processor_class(ds_transforms, augmentation_params, target_sizes)    
+                break
+            selected_indices = select_indices(load_data.num_neg, chunk_size, streams.generator(random_streams.NEG_COL, n))
+            tasks = [((random_streams.NEG_COL, n, k), index) for k, index in enumerate(selected_indices)]
+            labels = np.zeros(chunk_size)
+            process_func = processor_class(ds_transforms, augmentation_params, target_sizes, streams=streams)    
         
-        target_arrays = [np.empty((chunk_size, size_x, size_y, IMAGE_NUM_CHANNELS), dtype='float32') for size_x, size_y in target_sizes]
-        pool = mp.Pool(NUM_PROCESSES)
-        gen = pool.imap(process_func, selected_indices, chunksize=loadsize) # lower chunksize seems to help to keep memory usage in check
+            target_arrays = [np.empty((chunk_size, size_x, size_y, IMAGE_NUM_CHANNELS), dtype=CHUNK_DTYPE) for size_x, size_y in target_sizes]
+            gen = pool.imap(process_func, tasks, chunksize=loadsize) # lower chunksize seems to help to keep memory usage in check
         
-        for k, imgs in enumerate(gen):
-            for i, image in enumerate(imgs):
-              target_arrays[i][k] =	image 
-        pool.close()
-        pool.join()
+            for k, imgs in enumerate(gen):
+                for i, image in enumerate(imgs):
+                  target_arrays[i][k] =	image 
         
-        target_arrays.append(labels.astype(np.int32))
+            target_arrays.append(labels.astype(np.int32))
         
-        yield target_arrays, chunk_size
-        n += 1
+            yield target_arrays, chunk_size
+            n += 1
 
 def realtime_augmented_data_gen_pos_col(num_chunks=None,chunk_size=CHUNK_SIZE, augmentation_params=default_augmentation_params,          #keep
-                                ds_transforms=ds_transforms_default, target_sizes=None, processor_class=LoadAndProcessPosCol):
+                                ds_transforms=ds_transforms_default, target_sizes=None, processor_class=LoadAndProcessPosColBatch, pool=None, num_processes=None, seed=None):
     """
     new version, using Pool.imap instead of Pool.map, to avoid the data structure conversion
     from lists to numpy arrays afterwards.
+    Each pool task composes and augments a batch of loadsize positives at once, so
+    processor_class takes a list of (stream key, (lens, source) indices) tasks.
+    All the random draws come from random_streams seeded with `seed`, so a seed fixes the chunks.
     """
     if target_sizes is None:
         target_sizes = [(53, 53) for _ in range(len(ds_transforms))]
-    n = 0 
-    while True:
-        if num_chunks is not None and n >= num_chunks:
+    streams = random_streams.RandomStreams(seed)
+    with pool_scope(pool, num_processes) as pool:
+        n = 0 
+        while True:
+            if num_chunks is not None and n >= num_chunks:
             
-            break
-        selected_indices1 = select_indices(num_lenses, chunk_size)
-        selected_indices2 = select_indices(num_sources, chunk_size)
+                break
+            chunk_rng = streams.generator(random_streams.POS_COL, n)
+            selected_indices1 = select_indices(load_data.num_lenses, chunk_size, chunk_rng)
+            if load_data.registry.source_sampler is not None:
+                selected_indices2 = load_data.registry.source_sampler.sample(chunk_size, chunk_rng)
+            else:
+                selected_indices2 = select_indices(load_data.num_sources, chunk_size, chunk_rng)
         
-        selected_indices=zip(selected_indices1,selected_indices2)
+            selected_indices=list(zip(selected_indices1,selected_indices2))
+            tasks = [((random_streams.POS_COL, n, k), indices) for k, indices in enumerate(selected_indices)]
         
-        labels = np.ones(chunk_size)
+            labels = np.ones(chunk_size)
         
-        process_func = processor_class(ds_transforms, augmentation_params, target_sizes)    
+            process_func = processor_class(ds_transforms, augmentation_params, target_sizes, streams=streams)    
         
-        target_arrays = [np.empty((chunk_size, size_x, size_y, IMAGE_NUM_CHANNELS), dtype='float32') for size_x, size_y in target_sizes]
-        pool = mp.Pool(NUM_PROCESSES)
-        gen = pool.imap(process_func, selected_indices, chunksize=loadsize) # lower chunksize seems to help to keep memory usage in check
+            target_arrays = [np.empty((chunk_size, size_x, size_y, IMAGE_NUM_CHANNELS), dtype=CHUNK_DTYPE) for size_x, size_y in target_sizes]
+            gen = pool.imap(process_func, batches(tasks))
         
-        for k, imgs in enumerate(gen):
-            for i, image in enumerate(imgs):
-              target_arrays[i][k] =	image
-              
-        pool.close()
-        pool.join()
+            k = 0
+            for imgs in gen:
+                for i, images in enumerate(imgs):
+                  target_arrays[i][k:k+len(images)] = images
+                k += len(imgs[0])
         
-        target_arrays.append(labels.astype(np.int32))
+            target_arrays.append(labels.astype(np.int32))
         
-        yield target_arrays, chunk_size
-        n += 1
+            yield target_arrays, chunk_size
+            n += 1
 
 
 def realtime_fixed_augmented_data_test_col(ds_transforms=ds_transforms_default, augmentation_transforms=[tform_identity],     #keep
-                                        chunk_size=4000, target_sizes=None, processor_class=LoadAndProcessFixedTestCol):
+                                        chunk_size=4000, target_sizes=None, processor_class=LoadAndProcessFixedTestColBatch, test_paths=None, pool=None, num_processes=None,
+                                        io_threads=IO_THREADS, io_depth=IO_DEPTH, process_depth=PROCESS_DEPTH):
     """
     by default, only the identity transform is in the augmentation list, so no augmentation occurs (only ds_transforms are applied).
+    test_paths defaults to the r-band cutouts in test_path.
+    Each pool task composes a batch of loadsize cutouts at once, so processor_class takes a (paths, files) batch.
+    See fixed_test_chunks for the reading / composing pipeline.
     """
-    selected_indices=np.arange(num_test)
-    num_ids_per_chunk = (chunk_size // len(augmentation_transforms)) # number of datapoints per chunk - each datapoint is multiple entries!
-    num_chunks = int(np.ceil(len(selected_indices) / float(num_ids_per_chunk)))
-
+    if test_paths is None:
+        test_paths = get_test_data()
     if target_sizes is None:
         target_sizes = [(53, 53) for _ in range(len(ds_transforms))]
 
     process_func = processor_class(ds_transforms, augmentation_transforms, target_sizes)
 
-    for n in range(num_chunks):
-        indices_n = selected_indices[n * num_ids_per_chunk:(n+1) * num_ids_per_chunk]
-        current_chunk_size = len(indices_n) * len(augmentation_transforms) # last chunk will be shorter!
-
-        target_arrays = [np.empty((current_chunk_size, size_x, size_y, IMAGE_NUM_CHANNELS), dtype='float32') for size_x, size_y in target_sizes]
-
-        pool = mp.Pool(NUM_PROCESSES)
-        gen = pool.imap(process_func, indices_n, chunksize=loadsize) # lower chunksize seems to help to keep memory usage in check
-
-        for k, imgs_aug in enumerate(gen):
-            for i, imgs in enumerate(imgs_aug):
-                    target_arrays[i][k] = imgs
-
-        pool.close()
-        pool.join()
-
-        yield target_arrays, current_chunk_size
+    return fixed_test_chunks(process_func, test_paths, len(augmentation_transforms), chunk_size, target_sizes,
+                             pool, num_processes, io_threads, io_depth, process_depth)
 
 def realtime_fixed_augmented_data_test(ds_transforms=ds_transforms_default, augmentation_transforms=[tform_identity],    #keep
-                                        chunk_size=500,target_sizes=None, processor_class=LoadAndProcessFixedTest):
+                                        chunk_size=500,target_sizes=None, processor_class=LoadAndProcessFixedTestBatch, test_paths=None, pool=None, num_processes=None,
+                                        io_threads=IO_THREADS, io_depth=IO_DEPTH, process_depth=PROCESS_DEPTH, stretch='sqrt'):
     """
     by default, only the identity transform is in the augmentation list, so no augmentation occurs (only ds_transforms are applied).
+    test_paths defaults to the r-band cutouts in test_path.
+    processor_class takes a (paths, files) batch; see fixed_test_chunks for the pipeline.
+    stretch must be the one the model was trained with (see stretch_chunk).
     """
-    selected_indices=np.arange(num_test)
-    num_ids_per_chunk = (chunk_size // len(augmentation_transforms)) # number of datapoints per chunk - each datapoint is multiple entries!
-    num_chunks = int(np.ceil(len(selected_indices) / float(num_ids_per_chunk)))
-
+    if test_paths is None:
+        test_paths = get_test_data()
     if target_sizes is None: 
         target_sizes = [(53, 53) for _ in range(len(ds_transforms))]
 
-    process_func = processor_class(ds_transforms, augmentation_transforms, target_sizes)
+    process_func = processor_class(ds_transforms, augmentation_transforms, target_sizes, stretch=stretch)
 
-    for n in range(num_chunks):
-        indices_n = selected_indices[n * num_ids_per_chunk:(n+1) * num_ids_per_chunk]
-        current_chunk_size = len(indices_n) * len(augmentation_transforms) # last chunk will be shorter!
+    return fixed_test_chunks(process_func, test_paths, len(augmentation_transforms), chunk_size, target_sizes,
+                             pool, num_processes, io_threads, io_depth, process_depth)
 
-        target_arrays = [np.empty((current_chunk_size, size_x, size_y, IMAGE_NUM_CHANNELS), dtype='float32') for size_x, size_y in target_sizes]
-
-        pool = mp.Pool(NUM_PROCESSES)
-        gen = pool.imap(process_func, indices_n, chunksize=100) # lower chunksize seems to help to keep memory usage in check
-
-        for k, imgs_aug in enumerate(gen):
-            for i, imgs in enumerate(imgs_aug):
-                    target_arrays[i][k] = imgs
- 
-        pool.close()
-        pool.join()
-
-        yield target_arrays, current_chunk_size
-        
+def fixed_test_chunks(process_func, test_paths, num_transforms, chunk_size, target_sizes, pool=None, num_processes=None,
+                      io_threads=IO_THREADS, io_depth=IO_DEPTH, process_depth=PROCESS_DEPTH):
+    """
+    Chunks of the test set, produced by three overlapping stages with bounded queues:
+    io_threads threads read the FITS files of up to io_depth batches ahead (I/O bound),
+    the process pool decodes and preprocesses up to process_depth batches at a time
+    (CPU bound), and the chunks are assembled for the consumer - the model, which reads
+    them through buffered_gen_mp, so it does not wait for the disk either.
+    """
+    num_ids_per_chunk = (chunk_size // num_transforms) # number of datapoints per chunk - each datapoint is multiple entries!
+    chunks = batches(test_paths, num_ids_per_chunk)
+    # batches never straddle two chunks, so the stages keep running across chunk boundaries
+    work = [batch for chunk in chunks for batch in batches(chunk)]
+
+    with pool_scope(pool, num_processes) as pool:
+        with contextlib.closing(prefetch_files(work, process_func.files_of, io_threads, io_depth)) as files:
+            results = bounded_imap(pool, process_func, files, process_depth)
+            for chunk in chunks:
+                current_chunk_size = len(chunk) * num_transforms # last chunk will be shorter!
+
+                target_arrays = [np.empty((current_chunk_size, size_x, size_y, IMAGE_NUM_CHANNELS), dtype='float32') for size_x, size_y in target_sizes]
+
+                k = 0
+                while k < len(chunk):
+                    imgs_aug = next(results)
+                    for i, imgs in enumerate(imgs_aug):
+                        target_arrays[i][k:k+len(imgs)] = imgs
+                    k += len(imgs_aug[0])
+
+                yield target_arrays, current_chunk_size
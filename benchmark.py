@@ -0,0 +1,420 @@
+"""
+Benchmarks for the data pipeline. Run from the repository root as
+
+    python benchmark.py [--json results.json] <name> ...
+
+where <name> is one of the keys of `benchmarks` below (all of them if none is given).
+With --json the results also go to a file, together with the machine they ran on, so
+that runs can be compared.
+"""
+
+import sys
+import os
+import time
+import json
+import argparse
+import platform
+import datetime
+import resource
+import tempfile
+import tracemalloc
+import subprocess
+import numpy as np
+
+
+def _time_in_subprocess(code):
+    """Runs `code` in a fresh interpreter; it must print its timings, space separated."""
+    out = subprocess.check_output([sys.executable, '-c', code])
+    return [float(t) for t in out.split()]
+
+
+def _pad_psf_loop(psf, nx=101, ny=101):
+    # the double loop load_data used to pad PSFs with at import
+    nx_, ny_ = np.shape(psf)
+    padded = np.zeros((nx, ny))
+    dx = (nx - nx_) // 2
+    dy = (ny - ny_) // 2
+    for ii in range(nx_):
+        for jj in range(ny_):
+            padded[ii + dx][jj + dy] = psf[ii][jj]
+    return padded
+
+
+# what importing load_data used to read, before the registry made it lazy
+eager_resources = ('train_ids_lens', 'train_ids_source', 'train_ids_neg', 'train_ids_real_lenses',
+                   'cutout_dict_train_neg', 'cutout_dict_train_lens', 'cutout_dict_train_source',
+                   'cutout_dict_train_real_lenses', 'PSF_i', 'PSF_g', 'PSF_r', 'seds')
+
+
+def bench_startup(repeats=3):
+    """
+    Import cost of load_data now that resources load lazily, against the eager
+    import it replaces: import, then every resource the old import read, with the PSFs
+    padded by the old double loop. Both are timed in fresh interpreters.
+    """
+    import load_data
+    from astropy.io import fits
+
+    code = ("import time; t0 = time.time(); import load_data; t1 = time.time(); "
+            "load_data.registry.load_all(); t2 = time.time(); print(t1 - t0, t2 - t1)")
+    timings = np.array([_time_in_subprocess(code) for _ in range(repeats)])
+    import_time, load_time = timings.min(axis=0)
+
+    code = ("import time; t0 = time.time(); import load_data, benchmark; load_data.pad_psf = benchmark._pad_psf_loop; "
+            "[getattr(load_data.registry, name) for name in benchmark.eager_resources]; print(time.time() - t0)")
+    eager_time = min(_time_in_subprocess(code)[0] for _ in range(repeats))
+
+    psf = fits.getdata(load_data.registry.data_path+'PSF_KIDS_175.0_-0.5_r.fits')
+    start = time.time()
+    _pad_psf_loop(psf)
+    pad_loop = time.time() - start
+    start = time.time()
+    load_data.pad_psf(psf)
+    pad_slice = time.time() - start
+
+    return {'import_lazy_s': import_time,
+            'load_all_s': load_time,
+            'pad_psf_loop_s': pad_loop,
+            'pad_psf_slice_s': pad_slice,
+            'import_eager_s': eager_time}
+
+
+def bench_warp(n=256, size=101):
+    """
+    warp_batch on a (n,size,size,3) stack against the per-image, per-channel path it
+    replaces (skimage's private _warp_fast, timed only when this skimage still has it),
+    and the vectorised augmentation matrices against composing AffineTransforms.
+    """
+    import augmentation as ra
+    params = {'zoom_range': (1/1.1, 1.), 'rotation_range': (0, 180), 'shear_range': (0, 0),
+              'translation_range': (-4, 4), 'do_flip': True}
+    imgs = np.random.rand(n, size, size, 3).astype('float32')
+
+    start = time.time()
+    tforms = [ra.random_perturbation_transform(**params) for _ in range(n)]
+    compose_loop = time.time() - start
+    start = time.time()
+    matrices = ra.random_perturbation_matrices(n, **params)
+    compose_batch = time.time() - start
+
+    start = time.time()
+    ra.warp_batch(imgs, matrices, output_shape=(size, size))
+    results = {'compose_loop_s': compose_loop,
+               'compose_batch_s': compose_batch,
+               'warp_batch_s': time.time() - start}
+    try:
+        from skimage.transform._warps_cy import _warp_fast
+    except ImportError:
+        return results
+    start = time.time()
+    for img, tform in zip(imgs, tforms):
+        warped = np.empty((size, size, 3), dtype='float32')
+        for k in range(3):
+            warped[..., k] = _warp_fast(img[..., k].astype('float64'), tform.params, output_shape=(size, size), mode='reflect')
+    results['warp_loop_private_s'] = time.time() - start
+    return results
+
+
+def bench_compose(n=512, size=101):
+    """
+    HumVI composition of n synthetic (size,size) i/r/g cutouts with mock sources:
+    rgb_composer_batch on the stacks against rgb_composer_arrays image by image.
+    """
+    import HumVI_online_lensing as rgb
+    bands = [np.random.normal(2e-12, 1e-11, (n, size, size)).astype('float32') for _ in range(3)]
+    sources = [np.random.rand(n, size, size)*1e-12 for _ in range(3)]
+    calibs = [np.full(n, 1e12) for _ in range(3)]
+
+    start = time.time()
+    for k in range(n):
+        rgb.rgb_composer_arrays(*[band[k] for band in bands+sources], calibs=[calib[k] for calib in calibs])
+    loop = time.time() - start
+    start = time.time()
+    rgb.rgb_composer_batch(*bands+sources, calibs=calibs)
+    batch = time.time() - start
+
+    return {'compose_loop_us_per_image': 1e6 * loop / n,
+            'compose_batch_us_per_image': 1e6 * batch / n}
+
+
+def _kids_header(band):
+    from astropy.io import fits
+    hdr = fits.Header()
+    hdr['TELESCOP'] = 'ESO-VLT-U0' # HumVI calibrates these as KiDS coadds
+    hdr['INSTRUME'] = 'OMEGACAM'
+    hdr['FILTER'] = band+'_SDSS'
+    hdr['BUNIT'] = 'ADU'
+    return hdr
+
+
+def make_fixture(path, n=64, size=101, psf_size=25, seed=0):
+    """
+    Writes synthetic training data under `path`, shaped like the real cutouts: n i/r/g
+    float32 lenses and negatives with KiDS headers (a galaxy on sky noise), n float64
+    sources with LENSER and MAG, and a Moffat-like PSF per band. Returns the r-band lens,
+    negative and source file lists and the PSF files by band.
+    """
+    from astropy.io import fits
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:size, :size] - size // 2
+    fixture = {'lenses': [], 'negatives': [], 'sources': [], 'psf': {}}
+    for kind in ('lenses', 'negatives', 'sources'):
+        os.makedirs(os.path.join(path, kind), exist_ok=True)
+    for k in range(n):
+        for kind in ('lenses', 'negatives'):
+            radius = rng.uniform(2, 6)
+            galaxy = 5e-11 * np.exp(-(xx ** 2 + yy ** 2) / (2 * radius ** 2))
+            for band in ('r', 'g', 'i'):
+                image = galaxy * rng.uniform(0.5, 1.5) + rng.normal(0, 1e-12, (size, size))
+                filename = os.path.join(path, kind, 'KIDS_%d_%s_sci.fits' % (k, band))
+                fits.writeto(filename, image.astype('float32'), _kids_header(band), overwrite=True)
+            fixture[kind].append(os.path.join(path, kind, 'KIDS_%d_r_sci.fits' % k))
+        hdr = fits.Header()
+        hdr['LENSER'] = rng.uniform(0.5, 3.)
+        hdr['MAG'] = rng.uniform(20., 25.)
+        arc = np.exp(-(np.hypot(xx, yy) - 10 * hdr['LENSER']) ** 2 / 4.) * rng.random((size, size))
+        filename = os.path.join(path, 'sources', 'source_%d.fits' % k)
+        fits.writeto(filename, arc, hdr, overwrite=True)
+        fixture['sources'].append(filename)
+    py, px = np.mgrid[:psf_size, :psf_size] - psf_size // 2
+    for band, fwhm in (('r', 3.5), ('g', 4.5), ('i', 4.)):
+        psf = (1 + (px ** 2 + py ** 2) / (fwhm / 2.) ** 2) ** -3.
+        fixture['psf'][band] = os.path.join(path, 'PSF_%s.fits' % band)
+        fits.writeto(fixture['psf'][band], psf / psf.sum(), overwrite=True)
+    return fixture
+
+
+def _sqrt_normalise_loop(imgs, target):
+    # the per-image loop of realtime_augmented_data_gen_neg/_pos
+    for k, image in enumerate(imgs):
+        scale_min = 0
+        scale_max = image.max()
+        image.clip(min=scale_min, max=scale_max)
+        indices = np.where(image < 0)
+        image[indices] = 0.0
+        new_img = np.sqrt(image)
+        new_img = (new_img / new_img.max()*255.)
+        target[k] = new_img
+
+
+def _transport_chunks(num_chunks, shape, dtype):
+    chunk = np.ones(shape, dtype=dtype)
+    labels = np.zeros(shape[0], dtype='int32')
+    for _ in range(num_chunks):
+        yield [chunk, labels], shape[0]
+
+
+def _cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _measure(func, n):
+    """
+    Wall time per image, images per CPU second (this process and the children it
+    waited for) and peak Python-traced allocation in MB of func(), which handles n
+    images. Memory is traced in a second run so tracing does not slow the timed one.
+    """
+    wall, cpu = time.perf_counter(), _cpu_seconds()
+    func()
+    wall, cpu = time.perf_counter() - wall, _cpu_seconds() - cpu
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'us_per_image': 1e6 * wall / n,
+            'images_per_cpu_s': n / cpu if cpu > 0 else float('inf'),
+            'peak_mb': peak / 2. ** 20}
+
+
+def bench_stages(n=128, size=101, chunk_size=512, num_chunks=8, path=None):
+    """
+    Every stage of the training pipeline on its own, on a synthetic fixture written by
+    make_fixture (to a temporary directory unless `path` is given): fits.getdata of the
+    cutouts, the PSF fftconvolve of the sources, rgb_composer on i/r/g files, fast_warp
+    with a random augmentation, the sqrt/normalise stretch of the single-band chunks
+    and the buffered_gen_mp transport of (chunk_size,size,size,3) CHUNK_DTYPE chunks. The files are
+    read from the page cache, so getdata and rgb_composer leave cold reads out, and the
+    transport peak leaves out its shared-memory slots, which are not Python allocations.
+    """
+    import scipy.signal
+    from astropy.io import fits
+    import load_data
+    import augmentation as ra
+    import HumVI_online_lensing as rgb
+    import packed_store
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fixture = make_fixture(path or tmp, n=n, size=size)
+        sources = [fits.getdata(filename) for filename in fixture['sources']]
+        psf = load_data.pad_psf(fits.getdata(fixture['psf']['r']), size, size)
+        imgs = np.stack([np.dstack([fits.getdata(filename)] * 3) for filename in fixture['negatives']])
+        params = {'zoom_range': (1/1.1, 1.), 'rotation_range': (0, 180), 'shear_range': (0, 0),
+                  'translation_range': (-4, 4), 'do_flip': True}
+        tforms = [ra.random_perturbation_transform(**params) for _ in range(n)]
+
+        def transport():
+            for chunk, _ in load_data.buffered_gen_mp(_transport_chunks(num_chunks, (chunk_size, size, size, 3), ra.CHUNK_DTYPE)):
+                chunk[0].max() # read it, as the minibatch loop would
+
+        stages = [
+            ('getdata', lambda: [fits.getdata(filename) for filename in fixture['lenses']], n),
+            ('fftconvolve', lambda: [scipy.signal.fftconvolve(source, psf, mode='same') for source in sources], n),
+            ('rgb_composer', lambda: [np.asarray(rgb.rgb_composer(packed_store.band_name(filename, 'i'), filename, packed_store.band_name(filename, 'g')))
+                                      for filename in fixture['negatives']], n),
+            ('fast_warp', lambda: [ra.fast_warp(img, tform, output_shape=(size, size)) for img, tform in zip(imgs, tforms)], n),
+            ('sqrt_normalise', lambda: ra.stretch_chunk(imgs), n), # in place, nothing uses imgs after
+            ('transport', transport, num_chunks * chunk_size),
+        ]
+        results = {}
+        for stage, func, count in stages:
+            for key, value in _measure(func, count).items():
+                results['%s_%s' % (stage, key)] = value
+    chunk_mb = chunk_size * size * size * 3 * np.dtype(ra.CHUNK_DTYPE).itemsize / 2. ** 20
+    results['transport_mb_per_s'] = chunk_mb / chunk_size / (results['transport_us_per_image'] * 1e-6)
+    return results
+
+
+def bench_normalise(n=1280, size=101, stretch='sqrt'):
+    """
+    Stretch and normalisation of a (n,size,size,3) single-band chunk: stretch_chunk in
+    place against the per-image loop the generators used.
+    """
+    import augmentation as ra
+    chunk = np.random.normal(0.2, 1, (n, size, size, 3)).astype('float32')
+    target = np.empty_like(chunk)
+
+    imgs = chunk.copy()
+    start = time.time()
+    _sqrt_normalise_loop(imgs, target)
+    loop = time.time() - start
+    start = time.time()
+    ra.stretch_chunk(chunk, stretch)
+    return {'normalise_loop_us_per_image': 1e6 * loop / n,
+            'stretch_chunk_us_per_image': 1e6 * (time.time() - start) / n}
+
+
+resnet_variants = {
+    'resnet18': {'depth': 18},
+    'resnet18_w0.5': {'depth': 18, 'width_multiplier': 0.5},
+    'resnet18_separable': {'depth': 18, 'separable': True},
+    'resnet18_w0.5_separable': {'depth': 18, 'width_multiplier': 0.5, 'separable': True},
+    'resnet10_w0.5_stem3x3': {'depth': 10, 'width_multiplier': 0.5, 'stem_kernel_size': (3, 3), 'stem_strides': (2, 2), 'stem_pool': False},
+    'resnet10_w0.25_separable_stem3x3': {'depth': 10, 'width_multiplier': 0.25, 'separable': True,
+                                         'stem_kernel_size': (3, 3), 'stem_strides': (2, 2), 'stem_pool': False},
+}
+
+
+def model_flops(model):
+    """
+    Floating point operations (2 per multiply-add) of one forward pass of one image
+    through the convolutions and dense layers of `model`; normalisation, activations,
+    pooling and additions are left out.
+    """
+    from keras.layers import Conv2D, SeparableConv2D, Dense
+    flops = 0
+    for layer in model.layers:
+        if isinstance(layer, SeparableConv2D):
+            _, rows, cols, filters = layer.output_shape
+            channels = layer.input_shape[-1] * layer.depth_multiplier
+            flops += 2 * rows * cols * channels * (np.prod(layer.kernel_size) + filters)
+        elif isinstance(layer, Conv2D):
+            _, rows, cols, filters = layer.output_shape
+            flops += 2 * rows * cols * layer.input_shape[-1] * np.prod(layer.kernel_size) * filters
+        elif isinstance(layer, Dense):
+            flops += 2 * layer.input_shape[-1] * layer.units
+    return int(flops)
+
+
+def bench_resnet(n=256, batch_size=32, size=101, variants=None):
+    """
+    FLOPs per image, parameter count and measured CPU images/s of model.predict for
+    the ResnetBuilder variants in `resnet_variants` on (size,size,3) uint8 inputs.
+    """
+    from keras import backend as K
+    import resnet
+    images = np.random.randint(0, 256, (n, size, size, 3)).astype('uint8')
+    results = {}
+    for name, options in sorted((variants or resnet_variants).items()):
+        options = dict(options)
+        builder = getattr(resnet.ResnetBuilder, 'build_resnet_%d' % options.pop('depth'))
+        model = builder((size, size, 3), 1, rescale=(1 / 255., 0), **options)
+        model.predict(images[:batch_size], batch_size=batch_size) # warm up
+        start = time.time()
+        model.predict(images, batch_size=batch_size)
+        results[name+'_images_per_s'] = n / (time.time() - start)
+        results[name+'_mflops'] = model_flops(model) / 1e6
+        results[name+'_params'] = model.count_params()
+        K.clear_session()
+    return results
+
+
+def bench_predict_scaling(n=256, max_workers=None, num_transforms=4):
+    """
+    Images/s of sharded_predict.predict_sharded on n fixture test cutouts with 1, 2, 4, ...
+    up to max_workers (default: the available cores) processes, the cores split evenly
+    between them. The model of cnn.call_model gets random weights; the times include
+    starting the workers and loading the model, as in predict mode. Also checks that every
+    worker count gives the scores of one worker, in the same order.
+    """
+    import cnn
+    import sharded_predict
+    from keras import backend as K
+    max_workers = max_workers or len(os.sched_getaffinity(0))
+    counts = sorted(set([2 ** k for k in range(max_workers.bit_length()) if 2 ** k <= max_workers] + [max_workers]))
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = make_fixture(tmp, n=n, size=cnn.input_sizes[0][0])['negatives']
+        model_name = os.path.join(tmp, 'bench')
+        cnn.call_model().save_weights(model_name+'_weights_only.h5')
+        K.clear_session()
+        reference = None
+        for workers in counts:
+            start = time.time()
+            scores, _ = sharded_predict.predict_sharded(paths, workers, model_name, nbands=cnn.nbands, input_sizes=cnn.input_sizes,
+                                                        num_transforms=num_transforms, stretch=cnn.stretch)
+            elapsed = time.time() - start
+            if reference is None:
+                reference = (scores, elapsed)
+            results['workers_%d_images_per_s' % workers] = n / elapsed
+            results['workers_%d_speedup' % workers] = reference[1] / elapsed
+            results['workers_%d_max_score_difference' % workers] = float(np.max(np.abs(scores - reference[0])))
+    return results
+
+
+benchmarks = {
+    'startup': bench_startup,
+    'warp': bench_warp,
+    'compose': bench_compose,
+    'stages': bench_stages,
+    'normalise': bench_normalise,
+    'resnet': bench_resnet,
+    'predict_scaling': bench_predict_scaling,
+}
+
+
+def machine():
+    import numpy, scipy, astropy, skimage
+    return {'time': datetime.datetime.now().isoformat(),
+            'host': platform.node(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'versions': dict((module.__name__, module.__version__) for module in (numpy, scipy, astropy, skimage))}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks for the data pipeline.')
+    parser.add_argument('names', nargs='*', help='benchmarks to run: %s (default: all)' % ', '.join(sorted(benchmarks)))
+    parser.add_argument('--json', help='also write the results to this file, as JSON')
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.names or sorted(benchmarks):
+        results[name] = benchmarks[name]()
+        for key, value in sorted(results[name].items()):
+            print('%s %s: %s' % (name, key, value))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'machine': machine(), 'results': results}, f, indent=2, sort_keys=True)
@@ -15,8 +15,17 @@ import resnet
 import matplotlib.pyplot as plt 
 import time, os, glob, sys, datetime
 import numpy as np
+import pickle
 import load_data
 import augmentation as ra
+import training
+import pipeline_metrics
+import tta
+import prediction_writer
+import scan
+import quantize
+import inference_model
+import sharded_predict
 import argparse
 
 
@@ -37,9 +46,35 @@ batch_size= 64
 num_batch_augm=20 
 nbands=1
 normalize=True   # normalize the images to max of 255 (valid for single-band only)
+stretch='sqrt'   # single-band stretch before normalising: linear, sqrt, log or asinh (training, predict and scan)
+resize=False
+num_processes=2   # augmentation workers per generator, kept alive for the whole run
+seed=None         # seed of the training augmentation streams (None: a fresh one, printed at start)
+io_threads=4      # predict: threads reading test cutouts from disk
+io_depth=8        # predict: batches of test cutouts read ahead of the workers
+predict_workers=1 # predict: processes scoring contiguous shards of the test set (see sharded_predict.py)
+predict_threads=None  # predict with predict_workers > 1: threads per process (None: the cores split evenly)
 augm_pred=True    
+tta_transforms=4  # test-time symmetries averaged when augm_pred: 4 flips, or up to 8 with the 90 degree rotations
+tta_reduce='mean' # how the symmetries are combined per object: mean, max or median
+path_val='data/training/validation_col'   # held-out cutouts in lenses/ and negatives/ (quantize.py compares on them)
+tflite_model=None # predict/scan: score with this int8 model from quantize.py instead of the Keras weights
+fold_bn=True      # predict/scan: fold BatchNormalization into the convolutions (see inference_model.py)
+log_every=50      # print mean loss/accuracy every log_every minibatches
+metrics_log='jsonl'   # throughput metrics go to <model_name>_metrics.jsonl (or .csv) every log_every minibatches
+metrics_port=None     # serve the metrics for Prometheus at localhost:metrics_port/metrics (None: off)
+prefetch_batches=40   # minibatches prepared ahead of the model
+checkpoint_every=10   # save the weights every checkpoint_every chunks (0: only at the end)
+reduce_lr_patience=None   # halve the learning rate after this many chunks without a lower loss (None: never)
+scan_tiles='data/tiles/*_r_*.fits'   # scan mode: r-band coadd tiles, g and i next to them
+scan_stride=50    # scan mode: pixels between windows
+scan_catalogue=None   # scan mode: text file of ra dec (degrees) to score instead of the grid
+scan_threshold=0.5
+scan_merge_radius=50  # scan mode: detections closer than this (pixels) are merged
 #load_model=
 model_name='my_model'
+resnet_depth=18   # 10, 18, 34, 50, 101 or 152
+resnet_options={} # ResnetBuilder.build options, e.g. {'width_multiplier': 0.5, 'separable': True} (see benchmark.py resnet)
 learning_rate= 0.0001 
 	
 range_min=0.02
@@ -50,24 +85,13 @@ buffer_size=1
 avg_img=0
 input_shape=(input_sizes[0][0],input_sizes[0][1],3)
 test_path=ra.test_path
-test_data=ra.test_data
-
-def iterate_minibatches(inputs, targets, batchsize, shuffle=False):
-    assert len(inputs) == len(targets)
-    if shuffle:
-        indices = np.arange(len(inputs))
-        np.random.shuffle(indices)
-    for start_idx in range(0, len(inputs) - batchsize + 1, batchsize):
-        if shuffle:
-            excerpt = indices[start_idx:start_idx + batchsize]
-        else:
-            excerpt = slice(start_idx, start_idx + batchsize)
-        yield inputs[excerpt], targets[excerpt]       
 
 	
 def build_resnet():
 
-	model=resnet.ResnetBuilder.build_resnet_18(input_shape,1)#18
+	# the training chunks are uint8: the model scales them to [0,1] (minus avg_img) itself
+	builder=getattr(resnet.ResnetBuilder, 'build_resnet_%d' % resnet_depth)
+	model=builder(input_shape,1,rescale=(1/255.,avg_img),**resnet_options)
 	
 	
 	return model
@@ -80,6 +104,19 @@ def call_model(model='resnet'):
 
 	return multi_model
 
+def load_inference_model(multi_model, model_name, num_threads=None):
+	"""
+	The model predict and scan modes score with: tflite_model if set (with num_threads
+	interpreter threads), else multi_model with its trained weights, BatchNormalization
+	folded in if fold_bn.
+	"""
+	if tflite_model is not None:
+		return quantize.QuantizedModel(tflite_model, num_threads)
+	multi_model.load_weights(model_name+'_weights_only.h5')
+	if fold_bn:
+		return inference_model.fold_batchnorm(multi_model)
+	return multi_model
+
 def main(model='resnet', mode='train', num_chunks=num_chunks, chunk_size=chunk_size, input_sizes=input_sizes, batch_size=batch_size, nbands=nbands, model_name=model_name):   
 
 	multi_model=call_model(model=model)
@@ -90,42 +127,36 @@ def main(model='resnet', mode='train', num_chunks=num_chunks, chunk_size=chunk_s
 		
 		multi_model.compile(optimizer=loss, loss='binary_crossentropy', metrics=[metrics.binary_accuracy])  
 		
+		run_seed = np.random.SeedSequence(seed).entropy
+		print('augmentation seed: %d' % run_seed)
+
 		if nbands==3:
-			augmented_data_gen_pos = ra.realtime_augmented_data_gen_pos_col(num_chunks=num_chunks, chunk_size=chunk_size, target_sizes=input_sizes, augmentation_params=default_augmentation_params)
-			augmented_data_gen_neg = ra.realtime_augmented_data_gen_neg_col(num_chunks=num_chunks, chunk_size=chunk_size, target_sizes=input_sizes, augmentation_params=default_augmentation_params)
+			augmented_data_gen_pos = ra.realtime_augmented_data_gen_pos_col(num_chunks=num_chunks, chunk_size=chunk_size, target_sizes=input_sizes, augmentation_params=default_augmentation_params, num_processes=num_processes, seed=run_seed)
+			augmented_data_gen_neg = ra.realtime_augmented_data_gen_neg_col(num_chunks=num_chunks, chunk_size=chunk_size, target_sizes=input_sizes, augmentation_params=default_augmentation_params, num_processes=num_processes, seed=run_seed)
 			  
 		else:
-			augmented_data_gen_pos = ra.realtime_augmented_data_gen_pos(range_min=range_min, range_max=range_max, num_chunks=num_chunks, chunk_size=chunk_size, target_sizes=input_sizes, normalize=normalize , resize=resize, augmentation_params=default_augmentation_params)      
-			augmented_data_gen_neg = ra.realtime_augmented_data_gen_neg(num_chunks=num_chunks, chunk_size=chunk_size, target_sizes=input_sizes, normalize=normalize, resize=resize,augmentation_params=default_augmentation_params)      
+			augmented_data_gen_pos = ra.realtime_augmented_data_gen_pos(range_min=range_min, range_max=range_max, num_chunks=num_chunks, chunk_size=chunk_size, target_sizes=input_sizes, normalize=normalize , resize=resize, augmentation_params=default_augmentation_params, num_processes=num_processes, seed=run_seed, stretch=stretch)      
+			augmented_data_gen_neg = ra.realtime_augmented_data_gen_neg(num_chunks=num_chunks, chunk_size=chunk_size, target_sizes=input_sizes, normalize=normalize, resize=resize,augmentation_params=default_augmentation_params, num_processes=num_processes, seed=run_seed, stretch=stretch)      
 			
-		train_gen_neg = load_data.buffered_gen_mp(augmented_data_gen_neg, buffer_size=buffer_size) 
-		train_gen_pos = load_data.buffered_gen_mp(augmented_data_gen_pos, buffer_size=buffer_size) 
+		run_metrics = pipeline_metrics.Metrics()
+		if metrics_port:
+			pipeline_metrics.serve(run_metrics, metrics_port)
+		generated = run_metrics.shared_counter('generated_samples')
+		train_gen_neg = load_data.buffered_gen_mp(pipeline_metrics.counting(augmented_data_gen_neg, generated), buffer_size=buffer_size, stats=run_metrics.queue('neg')) 
+		train_gen_pos = load_data.buffered_gen_mp(pipeline_metrics.counting(augmented_data_gen_pos, generated), buffer_size=buffer_size, stats=run_metrics.queue('pos')) 
+		
+		callbacks = [training.StepLogger(log_every), CSVLogger(model_name+'_training.csv'),
+				pipeline_metrics.MetricsLogger(run_metrics, model_name+'_metrics.'+metrics_log, log_every)]
+		if checkpoint_every:
+			callbacks.append(ModelCheckpoint(model_name+'_weights_only.h5', monitor='loss', save_weights_only=True, period=checkpoint_every))
+		if reduce_lr_patience is not None:
+			callbacks.append(ReduceLROnPlateau(monitor='loss', factor=0.5, patience=reduce_lr_patience, verbose=1))
 		
+		start_time = time.time()
 		try:
-			for chunk in range(num_chunks):
-				start_time = time.time()
-				chunk_data_pos, chunk_length = next(train_gen_pos)  
-				y_train_pos = chunk_data_pos.pop()                   
-				X_train_pos = chunk_data_pos
-			
-				chunk_data_neg, _ = next(train_gen_neg)  
-				y_train_neg = chunk_data_neg.pop()                   
-				X_train_neg = chunk_data_neg
-			
-				X_train = np.concatenate((X_train_pos[0],X_train_neg[0]))
-				y_train=np.concatenate((y_train_pos,y_train_neg))
-				y_train=y_train.astype(np.int32)
-				y_train = np.expand_dims(y_train, axis=1)
-				train_batches = 0
-				batches = 0
-				for batch in iterate_minibatches(X_train, y_train, batch_size, shuffle=True):
-					X_batch, y_batch = batch
-					train = multi_model.fit(X_batch/255.-avg_img, y_batch)
-					batches += 1
-				X_train=None
-				y_train=None
-				print(chunk)
-				print(time.time()- start_time)
+			multi_model.fit_generator(training.minibatch_stream(train_gen_pos, train_gen_neg, batch_size, metrics=run_metrics),
+						steps_per_epoch=training.steps_per_chunk(chunk_size, batch_size), epochs=num_chunks,
+						callbacks=callbacks, verbose=0, max_queue_size=prefetch_batches, workers=1)
 			
 		except KeyboardInterrupt:
 			#multi_model.save(model_name+'_last.h5')
@@ -139,43 +170,57 @@ def main(model='resnet', mode='train', num_chunks=num_chunks, chunk_size=chunk_s
 		print('time employed ', end_time-start_time)
 
 	if mode=='predict':
-		if nbands==3:
-			augmented_data_gen_test_fixed = ra.realtime_fixed_augmented_data_test_col(target_sizes=input_sizes)#,normalize=normalize)
+		test_data=ra.get_test_data(test_path)
+		num_transforms = tta_transforms if augm_pred else 1
+		writer=prediction_writer.PredictionWriter('pred_'+model_name, num_transforms)
+		done=writer.done_paths()
+		remaining=[path for path in test_data if path not in done]
+		print('%d of %d test images already scored' % (len(test_data)-len(remaining), len(test_data)))
+		start_time=time.time()
+		if predict_workers > 1:
+			sharded_predict.predict_sharded(remaining, predict_workers, model_name, nbands=nbands, input_sizes=input_sizes, num_transforms=num_transforms,
+							reduce=tta_reduce, threads=predict_threads, io_threads=io_threads, io_depth=io_depth, writer=writer, stretch=stretch)
 		else:
-			augmented_data_gen_test_fixed = ra.realtime_fixed_augmented_data_test(target_sizes=input_sizes)
+			if nbands==3:
+				augmented_data_gen_test_fixed = ra.realtime_fixed_augmented_data_test_col(target_sizes=input_sizes, test_paths=remaining, num_processes=num_processes, io_threads=io_threads, io_depth=io_depth)#,normalize=normalize)
+			else:
+				augmented_data_gen_test_fixed = ra.realtime_fixed_augmented_data_test(target_sizes=input_sizes, test_paths=remaining, num_processes=num_processes, io_threads=io_threads, io_depth=io_depth, stretch=stretch)
+				
+			test_gen_fixed = load_data.buffered_gen_mp(augmented_data_gen_test_fixed, buffer_size=2)
 			
-		test_gen_fixed = load_data.buffered_gen_mp(augmented_data_gen_test_fixed, buffer_size=2)
-		
-		multi_model.load_weights(model_name+'_weights_only.h5')
+			multi_model=load_inference_model(multi_model, model_name)
 
-		predictions=[]
-		test_batches = 0
-		if augm_pred==True:
-			start_time=time.time()
+			scored = 0
 			for e, (chunk_data_test, chunk_length_test) in enumerate(test_gen_fixed):
 				X_test = chunk_data_test
 				X_test = X_test[0]
-				X_test=X_test/255.-avg_img
-				pred1=multi_model.predict(X_test) 
-				pred2=multi_model.predict(np.array([np.flipud(image) for image in X_test]))
-				pred3=multi_model.predict(np.array([np.fliplr(np.flipud(image)) for image in X_test]))
-				pred4=multi_model.predict(np.array([np.fliplr(image) for image in X_test]))
-				preds=np.mean([pred1, pred2, pred3, pred4], axis=0)
-				preds=preds.tolist()
-				predictions = predictions + preds
-	
-		else:
-			for e, (chunk_data_test, chunk_length_test) in enumerate(test_gen_fixed):
-				X_test = chunk_data_test
-				X_test = X_test[0]
-				X_test=X_test/255.-avg_img
-				pred1=multi_model.predict(X_test) 
-				preds=pred1.tolist()
-				predictions = predictions + preds		
+				preds, tta_preds=tta.predict_tta(multi_model, X_test, num_transforms=num_transforms, reduce=tta_reduce, return_all=True)
+				writer.write(remaining[scored:scored+len(X_test)], preds[:, 0], tta_preds[:, :, 0].T)
+				scored += len(X_test)
+		print('scored %d test images in %.1f s' % (len(remaining), time.time()-start_time))
 
+		# the whole run, in test_data order, in the format earlier runs produced
+		predictions = [[score] for score in writer.scores_for(test_data).tolist()]
 		with open('pred_'+model_name+'.pkl', 'wb') as f:
-			pickle.dump([[ra.test_data],[predictions]], f, pickle.HIGHEST_PROTOCOL)
+			pickle.dump([[test_data],[predictions]], f, pickle.HIGHEST_PROTOCOL)
 		
+	if mode=='scan':
+		multi_model=load_inference_model(multi_model, model_name)
+		cat_ra = cat_dec = None
+		if scan_catalogue is not None:
+			cat_ra, cat_dec = np.loadtxt(scan_catalogue, usecols=(0, 1), unpack=True, ndmin=2)
+		num_transforms = tta_transforms if augm_pred else 1
+		with open('scan_'+model_name+'.csv', 'w') as f:
+			f.write('tile,row,column,ra,dec,score\n')
+			for tile in sorted(glob.glob(scan_tiles)):
+				start_time=time.time()
+				detections=scan.scan_tile(multi_model, tile, nbands=nbands, stride=scan_stride, ra=cat_ra, dec=cat_dec, threshold=scan_threshold,
+							merge_radius=scan_merge_radius, num_transforms=num_transforms, reduce=tta_reduce, stretch=stretch)
+				for d in detections:
+					f.write('%s,%d,%d,%.6f,%.6f,%.4f\n' % (tile, d['row'], d['column'], d['ra'], d['dec'], d['score']))
+				f.flush()
+				print(tile, len(detections), 'detections', time.time()-start_time)
+
 if __name__ == "__main__":
     kwargs = {}
     if len(sys.argv) > 1:
@@ -0,0 +1,75 @@
+"""
+Bounded cache of composed colour images.
+
+A composite only depends on its files and on the HumVI parameters, so it is computed once
+and then looked up: first in an in-memory LRU tier (one per process, max_items images),
+then in an optional on-disk tier (one .npy per image under `path`, shared by all the
+workers and kept across runs). Entries are keyed by the r-band file name and the compose
+parameters, so changing the parameters never returns a stale image.
+"""
+
+import collections
+import hashlib
+import os
+import numpy as np
+
+
+class CompositeCache(object):
+
+    def __init__(self, max_items=2000, path=None, params=None):
+        self.max_items = max_items
+        self.path = path
+        self.params = repr(sorted((params or {}).items()))
+        self.memory = collections.OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, name):
+        return hashlib.sha1((name+'\n'+self.params).encode('utf-8')).hexdigest()
+
+    def get(self, name, compose):
+        """
+        The composite of `name`, calling compose() only if neither tier has it. The
+        returned array is shared with the cache and read-only.
+        """
+        key = self.key(name)
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+        image = self._load(key)
+        if image is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            image = np.asarray(compose())
+            self._save(key, image)
+        image.flags.writeable = False
+        self.memory[key] = image
+        if len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+        return image
+
+    def _filename(self, key):
+        return os.path.join(self.path, key[:2], key+'.npy')
+
+    def _load(self, key):
+        if self.path is None:
+            return None
+        try:
+            return np.load(self._filename(key))
+        except (IOError, ValueError):
+            # not cached yet, or a half-written file from an interrupted run
+            return None
+
+    def _save(self, key, image):
+        if self.path is None:
+            return
+        filename = self._filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # workers may compose the same image concurrently: write aside, then rename atomically
+        tmp = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, image)
+        os.replace(tmp, filename)
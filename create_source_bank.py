@@ -0,0 +1,17 @@
+"""
+Convolves every training source with the r, g and i PSFs once and packs the
+results (see packed_store.py), so the positive generators read pre-convolved
+arcs instead of running fftconvolve for every draw.
+"""
+
+import scipy.signal
+import packed_store
+import load_data
+
+path = "data/training/sources/"
+names = dict((k, v['name']) for k, v in load_data.cutout_dict_train_source.items())
+
+for band, PSF in (('r', load_data.PSF_r), ('g', load_data.PSF_g), ('i', load_data.PSF_i)):
+    print("Packing sources_psf_%s" % band)
+    packed_store.pack(names, 'sources_psf_'+band, path=path,
+                      transform=lambda image, PSF=PSF: scipy.signal.fftconvolve(image, PSF, mode='same'))
@@ -0,0 +1,142 @@
+"""
+Inference copy of a trained model, with the BatchNormalization layers folded away.
+
+At inference a BatchNormalization layer is the fixed per-channel affine map
+gamma * (y - mean) / sqrt(var + epsilon) + beta. When its input is the output of a
+convolution that nothing else reads, the map is folded into that convolution's kernel
+and bias, and the layer disappears. In the pre-activation ResNets of resnet.py that is
+the stem convolution and the inner convolutions of every block. A BatchNormalization
+right after a residual addition feeds a ReLU before the next convolution, so it
+cannot be folded and is kept. The copy also drops the regularisers and the
+training-only noise layers. Run as
+
+    python inference_model.py [model_name]
+
+to fold <model_name>_weights_only.h5 and check the copy against the trained model.
+"""
+
+import sys
+import numpy as np
+from keras.models import Model
+from keras.layers import Input, Lambda, BatchNormalization, Conv2D, SeparableConv2D, Dropout, GaussianNoise, GaussianDropout
+from keras.engine import InputLayer
+
+# layers that are the identity at inference
+training_only = (Dropout, GaussianNoise, GaussianDropout)
+
+
+def _as_list(x):
+    return x if isinstance(x, list) else [x]
+
+
+def _producer(tensor):
+    return tensor._keras_history[0]
+
+
+def foldable(model):
+    """{convolution layer name: the BatchNormalization layer folded into it} for `model`."""
+    consumers = {}
+    for layer in model.layers:
+        if isinstance(layer, InputLayer):
+            continue
+        for tensor in _as_list(layer.input):
+            consumers.setdefault(_producer(tensor).name, []).append(layer)
+    outputs = set(_producer(tensor).name for tensor in model.outputs)
+
+    folds = {}
+    for layer in model.layers:
+        if not isinstance(layer, BatchNormalization) or layer.axis not in (-1, len(layer.input_shape) - 1):
+            continue
+        conv = _producer(layer.input)
+        if isinstance(conv, (Conv2D, SeparableConv2D)) and len(consumers[conv.name]) == 1 and conv.name not in outputs:
+            folds[conv.name] = layer
+    return folds
+
+
+def _bn_scale_shift(bn):
+    """The per-channel scale and shift of the BatchNormalization layer bn at inference."""
+    weights = bn.get_weights()
+    gamma = weights.pop(0) if bn.scale else 1.
+    beta = weights.pop(0) if bn.center else 0.
+    mean, var = weights
+    scale = gamma / np.sqrt(var.astype('float64') + bn.epsilon)
+    return scale, beta - mean * scale
+
+
+def _fold(conv, bn):
+    """Weights of `conv` with `bn` folded in: the output channels scaled and a shifted bias."""
+    weights = conv.get_weights()
+    bias = weights.pop() if conv.use_bias else 0.
+    scale, shift = _bn_scale_shift(bn)
+    # the output channels are the last axis of the (pointwise) kernel
+    weights[-1] = weights[-1] * scale
+    return [w.astype('float32') for w in weights] + [(bias * scale + shift).astype('float32')]
+
+
+def _clone(layer, **overrides):
+    """A fresh copy of `layer` from its config, without regularisers."""
+    config = layer.get_config()
+    for key in config:
+        if key.endswith('regularizer'):
+            config[key] = None
+    config.update(overrides)
+    return layer.__class__.from_config(config)
+
+
+def fold_batchnorm(model):
+    """
+    An inference copy of the functional `model` (single inputs per layer call, as
+    resnet.py builds them): BatchNormalization folded into the convolutions before it
+    where that is exact, no regularisers and no training-only layers. The weights are
+    copied, so the copy and `model` are independent.
+    """
+    folds = foldable(model)
+    folded = set(bn.name for bn in folds.values())
+    new = {}
+    copies = []
+    for layer in model.layers:
+        if isinstance(layer, InputLayer):
+            new[id(layer.output)] = Input(batch_shape=layer.batch_input_shape, dtype=layer.dtype, name=layer.name)
+            continue
+        inputs = [new[id(tensor)] for tensor in _as_list(layer.input)]
+        inputs = inputs if isinstance(layer.input, list) else inputs[0]
+        if layer.name in folded or isinstance(layer, training_only):
+            output = inputs
+        elif isinstance(layer, Lambda):
+            output = layer(inputs) # weightless, and its function may be a closure that does not survive a config round trip
+        else:
+            copy = _clone(layer, use_bias=True) if layer.name in folds else _clone(layer)
+            output = copy(inputs)
+            copies.append((copy, layer))
+        new[id(layer.output)] = output
+
+    inference = Model(inputs=[new[id(tensor)] for tensor in model.inputs],
+                      outputs=[new[id(tensor)] for tensor in model.outputs])
+    for copy, layer in copies:
+        copy.set_weights(_fold(layer, folds[layer.name]) if layer.name in folds else layer.get_weights())
+    return inference
+
+
+def verify(model, inference, X, batch_size=32, atol=1e-4):
+    """Largest absolute difference of the two models' predictions on X; raises if above atol."""
+    difference = np.max(np.abs(model.predict(X, batch_size=batch_size) - inference.predict(X, batch_size=batch_size)))
+    if difference > atol:
+        raise ValueError('folded model differs from the trained one by %g (tolerance %g)' % (difference, atol))
+    return difference
+
+
+def main(model_name=None, num_samples=256, seed=3):
+    import cnn
+    import quantize
+    model_name = model_name or cnn.model_name
+    model = cnn.call_model()
+    model.load_weights(model_name+'_weights_only.h5')
+    inference = fold_batchnorm(model)
+    X, _ = quantize.training_sample(num_samples, seed)
+    print('layers: %d trained, %d inference (%d BatchNormalization folded)' % (len(model.layers), len(inference.layers), len(foldable(model))))
+    print('largest prediction difference: %g' % verify(model, inference, X))
+    return inference
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:2])
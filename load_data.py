@@ -7,9 +7,11 @@ import threading
 import skimage.transform
 import skimage.io
 import gzip
+import io
 import os
 import queue
 import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
 import pickle
 from astropy.io import fits
 import subprocess
@@ -18,67 +20,85 @@ import pyfits
 import time
 from PIL import Image
 import HumVI_online_lensing as rgb
+import humvi
+import packed_store
+import source_index
+import composite_cache
 
 preprocess=False
 
-train_ids_lens = np.load("data/train_ids_lens.npy")
-train_ids_source = np.load("data/train_ids_source.npy")
-train_ids_neg = np.load("data/train_ids_neg.npy")
-train_ids_real_lenses = np.load("data/train_ids_real_lenses.npy")
-
-dic_train_neg= "data/train_dic_neg.p" 
-cutout_dict_train_neg=pickle.load( open( dic_train_neg, "rb" ) )
-num_neg=len(cutout_dict_train_neg)
-
-dic_train_lens= "data/train_dic_lenses.p" 
-cutout_dict_train_lens=pickle.load( open( dic_train_lens, "rb" ) )
-num_lenses=len(cutout_dict_train_lens)
-
-dic_train_source= "data/train_dic_sources.p" 
-cutout_dict_train_source=pickle.load( open( dic_train_source, "rb" ) )
-num_sources=len(cutout_dict_train_source)
-
-dic_train_neg= "data/train_dic_real_lenses.p" 
-cutout_dict_train_real_lenses=pickle.load( open( dic_train_neg, "rb" ) )
-num_real_lenses=len(cutout_dict_train_real_lenses)
+source_cuts = {'LENSER': (1., None)} # sources with an Einstein radius below 1 are never drawn
 
+neg_col_cache_size = 2000 # composed colour negatives kept in memory by each worker (~30 kB each)
+neg_col_cache_path = None # directory of the on-disk tier of that cache, e.g. 'data/cache/neg_col/' (None: memory only)
 
 nx=101
 ny=101
-f1 = pyfits.open('data/PSF_KIDS_129.0_1.5_i.fits') #PSF
-d1= f1[0].data
-d1 = np.asarray(d1)
-nx_ , ny_ = np.shape (d1)
-PSF_i = np.zeros ( ( nx , ny ) ) #output
-dx = ( nx - nx_ ) // 2 #shift in x
-dy = ( ny - ny_ ) // 2 #shift in y
-for ii in range ( nx_ ): #iterating over input array
-    for jj in range ( ny_ ):
-        PSF_i[ ii + dx ] [ jj + dy ] = d1 [ ii ] [ jj ]
-
-f1 = pyfits.open('data/PSF_KIDS_133.4_ 2.5_g.fits') #PSF
-d1= f1[0].data
-d1 = np.asarray(d1)
-nx_ , ny_ = np.shape (d1)
-PSF_g = np.zeros ( ( nx , ny ) ) #output
-dx = ( nx - nx_ ) // 2 #shift in x
-dy = ( ny - ny_ ) // 2 #shift in y
-for ii in range ( nx_ ): #iterating over input array
-	for jj in range ( ny_ ):
-		PSF_g[ ii + dx ] [ jj + dy ] = d1 [ ii ] [ jj ]
-
-f1 = pyfits.open('data/PSF_KIDS_175.0_-0.5_r.fits') #PSF
-d1= f1[0].data
-d1 = np.asarray(d1)
-nx_ , ny_ = np.shape (d1)
-PSF_r = np.zeros ( ( nx , ny ) ) #output
-dx = ( nx - nx_ ) // 2 #shift in x
-dy = ( ny - ny_ ) // 2 #shift in y
-for ii in range ( nx_ ): #iterating over input array
-    for jj in range ( ny_ ):
-        PSF_r[ ii + dx ] [ jj + dy ] = d1 [ ii ] [ jj ]
-
-seds=np.loadtxt('data/SED_colours_2017-10-03.dat')
+
+def pad_psf(psf, nx=nx, ny=ny):
+    """Centres `psf` in an nx x ny array of zeros."""
+    psf = np.asarray(psf)
+    nx_, ny_ = np.shape(psf)
+    dx = ( nx - nx_ ) // 2 #shift in x
+    dy = ( ny - ny_ ) // 2 #shift in y
+    padded = np.zeros((nx, ny))
+    padded[dx:dx+nx_, dy:dy+ny_] = psf
+    return padded
+
+class DataRegistry(object):
+    """
+    Training resources (ids, cutout dictionaries, PSFs, SED table), each loaded on
+    first access and cached on the instance. Importing load_data therefore costs
+    nothing for predict-only runs, and workers only load what they actually use.
+    """
+
+    _loaders = {
+        'train_ids_lens': lambda self: np.load(self.data_path+"train_ids_lens.npy"),
+        'train_ids_source': lambda self: np.load(self.data_path+"train_ids_source.npy"),
+        'train_ids_neg': lambda self: np.load(self.data_path+"train_ids_neg.npy"),
+        'train_ids_real_lenses': lambda self: np.load(self.data_path+"train_ids_real_lenses.npy"),
+        'cutout_dict_train_neg': lambda self: self._load_dict("train_dic_neg.p"),
+        'cutout_dict_train_lens': lambda self: self._load_dict("train_dic_lenses.p"),
+        'cutout_dict_train_source': lambda self: self._load_dict("train_dic_sources.p"),
+        'cutout_dict_train_real_lenses': lambda self: self._load_dict("train_dic_real_lenses.p"),
+        'num_neg': lambda self: len(self.cutout_dict_train_neg),
+        'num_lenses': lambda self: len(self.cutout_dict_train_lens),
+        'num_sources': lambda self: len(self.cutout_dict_train_source),
+        'num_real_lenses': lambda self: len(self.cutout_dict_train_real_lenses),
+        'PSF_i': lambda self: pad_psf(fits.getdata(self.data_path+'PSF_KIDS_129.0_1.5_i.fits')),
+        'PSF_g': lambda self: pad_psf(fits.getdata(self.data_path+'PSF_KIDS_133.4_ 2.5_g.fits')),
+        'PSF_r': lambda self: pad_psf(fits.getdata(self.data_path+'PSF_KIDS_175.0_-0.5_r.fits')),
+        'seds': lambda self: np.loadtxt(self.data_path+'SED_colours_2017-10-03.dat'),
+        'source_index': lambda self: np.load(self.data_path+source_index.index_name) if os.path.exists(self.data_path+source_index.index_name) else None,
+        'source_sampler': lambda self: source_index.SourceSampler(self.source_index, **source_cuts) if self.source_index is not None else None,
+        'neg_col_cache': lambda self: composite_cache.CompositeCache(neg_col_cache_size, neg_col_cache_path, rgb.composer_settings()),
+    }
+
+    def __init__(self, data_path='data/'):
+        self.data_path = data_path
+
+    def __getattr__(self, name):
+        # only called for attributes that have not been loaded yet
+        if name not in DataRegistry._loaders:
+            raise AttributeError(name)
+        value = DataRegistry._loaders[name](self)
+        setattr(self, name, value)
+        return value
+
+    def _load_dict(self, filename):
+        with open(self.data_path+filename, "rb") as f:
+            return pickle.load(f)
+
+    def load_all(self):
+        """Loads every resource, e.g. in a parent process before forking workers."""
+        for name in DataRegistry._loaders:
+            getattr(self, name)
+
+registry = DataRegistry()
+
+def __getattr__(name):
+    # keeps module-level access (load_data.num_neg, load_data.PSF_r, ...) working, lazily
+    return getattr(registry, name)
 
 Rg=3.30
 Rr=2.31
@@ -86,15 +106,60 @@ Ri=1.71
 
 perc_range=(0.02,0.30)
 
+def read_cutout(store_name, cutout_dict, img_id, path=''):
+        """
+        Reads cutout `img_id` from the packed store `store_name` (a memmap view, no copy),
+        falling back to the FITS file named in `cutout_dict` if the class was not packed.
+        """
+        store = packed_store.open_store(store_name)
+        if store is not None:
+            return store[img_id]
+        return fits.getdata(path+cutout_dict[img_id]['name'])
+
+def read_band(store_prefix, cutout_dict, img_id, band, path=''):
+        """
+        The `band` cutout of `img_id` and its HumVI calibration factor, read from the packed
+        store `<store_prefix>_<band>` if it exists, otherwise from a single open of the FITS file.
+        """
+        name = cutout_dict[img_id]['name']
+        if band != 'r':
+            name = packed_store.band_name(name, band)
+        store = packed_store.open_store(store_prefix+'_'+band)
+        if store is not None:
+            image = store[img_id]
+            calib = store.calib(img_id)
+            if calib is None:
+                calib = humvi.calibration_factor(fits.getheader(path+name, -1))
+            return image, calib
+        return read_fits_band(path+name)
+
+def in_memory(name, files):
+        """The file `name` as an in-memory file if its contents were already read into `files`, else `name`."""
+        if files is not None and name in files:
+            return io.BytesIO(files[name])
+        return name
+
+def read_fits_band(filename):
+        """Image and HumVI calibration factor of the last HDU of `filename`, from a single open."""
+        with fits.open(filename) as hdulist:
+            return np.array(hdulist[-1].data), humvi.calibration_factor(hdulist[-1].header)
+
+def convolved_source(img_id, band, PSF):
+        """
+        Source `img_id` convolved with the `band` PSF, read from the precomputed source bank
+        (see create_source_bank.py) if it exists.
+        """
+        bank = packed_store.open_store('sources_psf_'+band)
+        if bank is not None:
+            return bank[img_id]
+        image= read_cutout('sources', registry.cutout_dict_train_source, img_id, "data/training/sources/")
+        return scipy.signal.fftconvolve (image, PSF, mode = 'same')
+
 def load_fits_source(img_id):
-        path = "data/training/sources/"
         image=None
         while image is None:
           try:
-            image= fits.getdata(path+cutout_dict_train_source[img_id]['name'])
-            image= scipy.signal.fftconvolve (image, PSF_r, mode = 'same')
-            hdulist = pyfits.open(path+cutout_dict_train_source[img_id]['name'])
-            prihdr = hdulist[0].header
+            image= convolved_source(img_id, 'r', registry.PSF_r)
             #ein_rad= prihdr['LENSER']
             #mags = prihdr['MAG']
             #if ein_rad < 1.:
@@ -113,14 +178,14 @@ def load_fits_source(img_id):
         return img
 
 def load_fits_lens(img_id):
-        image= fits.getdata(cutout_dict_train_lens[img_id]['name'])
-        image = image.astype('float32')
+        image= read_cutout('lenses_r', registry.cutout_dict_train_lens, img_id)
+        image = np.asarray(image, dtype='float32')
         image=np.expand_dims(image, axis=2)
         return image
 
 def load_fits_neg(img_id):
-        image= fits.getdata(cutout_dict_train_neg[img_id]['name'])
-        image = image.astype('float32')
+        image= read_cutout('negatives_r', registry.cutout_dict_train_neg, img_id)
+        image = np.asarray(image, dtype='float32')
         image=np.expand_dims(image, axis=2)
         return image
 
@@ -130,53 +195,100 @@ def load_fits_neg(img_id):
 #        img=np.expand_dims(image, axis=2)
 #        return image
 
-def load_fits_test(path, normalize=True):  #THIS IS USED FOR TEST TIME
+stretches = {
+    'linear': None,
+    'sqrt': np.sqrt,
+    'log': np.log1p,
+    'asinh': np.arcsinh,
+}
+
+def stretch_chunk(chunk, stretch='sqrt', normalize=True, softening=0.01):
+    """
+    Stretches a float (N,H,W[,C]) chunk in place and returns it: negative pixels set to 0,
+    then `stretch` (a key of `stretches`), then, with normalize, every image scaled to a
+    maximum of 255 (all-zero images stay 0). log and asinh stretch each image divided by
+    softening times its maximum. Per-image maxima come from one reduction over the chunk.
+    """
+    axes = tuple(range(1, chunk.ndim))
+    np.maximum(chunk, 0, out=chunk)
+    if stretch in ('log', 'asinh'):
+        peak = chunk.max(axis=axes, keepdims=True)
+        np.divide(chunk, softening * peak, out=chunk, where=peak > 0)
+    if stretches[stretch] is not None:
+        stretches[stretch](chunk, out=chunk)
+    if normalize:
+        peak = chunk.max(axis=axes, keepdims=True)
+        np.divide(chunk, peak, out=chunk, where=peak > 0)
+        chunk *= 255.
+    return chunk
+
+def load_fits_test(path, normalize=True, stretch='sqrt'):  #THIS IS USED FOR TEST TIME
         image= fits.getdata(path)
-        image = image.astype('float32')
-        img=np.array(image, copy=True)
-        scale_min = 0
-        scale_max = img.max()
-        img=img.clip(min=scale_min, max=scale_max)
-        indices = np.where(img < 0)
-        img[indices] = 0.0
-        imageData = np.sqrt(img)
-        if normalize:
-            imageData = (imageData / imageData.max()*255.)
-        new_img=np.flipud(imageData)
+        return preprocess_test(image, normalize, stretch)
+
+def preprocess_test(image, normalize=True, stretch='sqrt'):
+        """
+        Stretch (see stretch_chunk) of a single-band test cutout already in memory, as
+        load_fits_test applies it: use the stretch the model was trained with.
+        """
+        new_img = stretch_chunk(np.flipud(image).astype('float32')[None], stretch, normalize)[0]
         if preprocess:
           new_img=((new_img/255.)-0.5)*2
         
         return new_img
 
-def load_fits_pos_col(img_id_lens, img_id_src, perc_range=perc_range): 
-
-	lens_r = cutout_dict_train_lens[img_id_lens]['name']
-	lens_g = cutout_dict_train_lens[img_id_lens]['name'].split('_r_')[0]+'_g_'+cutout_dict_train_lens[img_id_lens]['name'].split('_r_')[1] #!!!
-	lens_i = cutout_dict_train_lens[img_id_lens]['name'].split('_r_')[0]+'_i_'+cutout_dict_train_lens[img_id_lens]['name'].split('_r_')[1]
-	lens_r_data=fits.getdata(cutout_dict_train_lens[img_id_lens]['name'])
+def load_fits_pos_col(img_id_lens, img_id_src, perc_range=perc_range, rng=None): 
+	bands, calibs = pos_col_bands(img_id_lens, img_id_src, perc_range, rng)
+	return rgb.rgb_composer_arrays(*bands, calibs=calibs)
+
+def load_fits_pos_col_batch(img_ids_lens, img_ids_src, perc_range=perc_range, rngs=None):
+	"""load_fits_pos_col for a batch of (lens, source) pairs, composed in one vectorised pass; rngs has one generator per pair."""
+	if rngs is None:
+		rngs = [None]*len(img_ids_lens)
+	bands, calibs = zip(*[pos_col_bands(img_id_lens, img_id_src, perc_range, rng) for img_id_lens, img_id_src, rng in zip(img_ids_lens, img_ids_src, rngs)])
+	return rgb.rgb_composer_batch(*[np.stack(band) for band in zip(*bands)], calibs=[np.array(calib) for calib in zip(*calibs)])
+
+def pos_col_bands(img_id_lens, img_id_src, perc_range=perc_range, rng=None):
+	"""
+	The i, r, g lens bands and the i, r, g mock source added to them, with the lens
+	calibration factors (i, r, g): everything load_fits_pos_col composes. The mock
+	parameters are drawn from the np.random.Generator rng.
+	"""
+	if rng is None:
+		rng = np.random.default_rng()
+
+	lens_r, calib_r = read_band('lenses', registry.cutout_dict_train_lens, img_id_lens, 'r')
+	lens_g, calib_g = read_band('lenses', registry.cutout_dict_train_lens, img_id_lens, 'g')
+	lens_i, calib_i = read_band('lenses', registry.cutout_dict_train_lens, img_id_lens, 'i')
+	lens_r_data=np.array(lens_r)
 	
-	perc=np.random.uniform(perc_range[0],perc_range[1])
+	perc=rng.uniform(perc_range[0],perc_range[1])
 	
 	path = "data/training/sources/"
 	image=None
 	while image is None:
 		try:
-			image= fits.getdata(path+cutout_dict_train_source[img_id_src]['name'])
-			hdulist = pyfits.open(path+cutout_dict_train_source[img_id_src]['name'])
+			image= convolved_source(img_id_src, 'r', registry.PSF_r)
+			if registry.source_sampler is not None:
+				break # the source was drawn from the index, it already passed the cuts
+			hdulist = pyfits.open(path+registry.cutout_dict_train_source[img_id_src]['name'])
 			prihdr = hdulist[0].header
 			ein_rad= prihdr['LENSER']
 			if ein_rad < 1.:
 				image=None
 				img_id_src=img_id_src+1	
 		except IOError:
-			img_id_src=np.random.randint(0, num_sources)
+			if registry.source_sampler is not None:
+				img_id_src=registry.train_ids_source[registry.source_sampler.sample(1, rng)[0]]
+			else:
+				img_id_src=rng.integers(0, registry.num_sources)
 			pass  
 	
-	index=np.random.randint(0, seds.shape[0])
-	ext_range=abs(np.random.normal(0,0.1))
-	r_mag=seds[index][3]+Rr*ext_range+np.random.uniform(-1,1)
-	g_mag=seds[index][2]+Rg*ext_range+np.random.uniform(-1,1)
-	i_mag=seds[index][4]+Ri*ext_range+np.random.uniform(-1,1)
+	index=rng.integers(0, registry.seds.shape[0])
+	ext_range=abs(rng.normal(0,0.1))
+	r_mag=registry.seds[index][3]+Rr*ext_range+rng.uniform(-1,1)
+	g_mag=registry.seds[index][2]+Rg*ext_range+rng.uniform(-1,1)
+	i_mag=registry.seds[index][4]+Ri*ext_range+rng.uniform(-1,1)
 	
 	gmr=g_mag-r_mag
 	rmi=r_mag-i_mag
@@ -184,13 +296,10 @@ def load_fits_pos_col(img_id_lens, img_id_src, perc_range=perc_range):
 	flux_g=10**(-0.4*gmr)
 	flux_i=10**(0.4*rmi)
 	
+	# convolution is linear, so the colour fluxes can scale the convolved bands
 	image_r=image
-	image_g=image*flux_g
-	image_i=image*flux_i
-	
-	image_r = scipy.signal.fftconvolve (image_r, PSF_r, mode = 'same')
-	image_g = scipy.signal.fftconvolve (image_g, PSF_g, mode = 'same')  
-	image_i = scipy.signal.fftconvolve (image_i, PSF_i, mode = 'same')
+	image_g=convolved_source(img_id_src, 'g', registry.PSF_g)*flux_g
+	image_i=convolved_source(img_id_src, 'i', registry.PSF_i)*flux_i
 	
 	lens_r_data[np.isnan(lens_r_data)]=0
 	lens_r_data[np.isinf(lens_r_data)]=0
@@ -201,11 +310,7 @@ def load_fits_pos_col(img_id_lens, img_id_src, perc_range=perc_range):
 	source_i=image_i/np.max(image_r)*lens_max*perc
 
 	
-	image=rgb.rgb_composer(lens_i,lens_r,lens_g,source_i,source_r,source_g)
-	final_img=np.asarray(image)			
-
-	
-	return final_img 
+	return (lens_i,lens_r,lens_g,source_i,source_r,source_g), (calib_i,calib_r,calib_g)
 
 #def load_fits_lens_col(img_id):
 #        path = "data/training/lenses/"
@@ -217,11 +322,18 @@ def load_fits_pos_col(img_id_lens, img_id_src, perc_range=perc_range):
 #        return image
 
 def load_fits_neg_col(img_id):
-        image_r = cutout_dict_train_neg[img_id]['name']
-        image_g = cutout_dict_train_neg[img_id]['name'].split('_r_')[0]+'_g_'+cutout_dict_train_neg[img_id]['name'].split('_r_')[1]
-        image_i = cutout_dict_train_neg[img_id]['name'].split('_r_')[0]+'_i_'+cutout_dict_train_neg[img_id]['name'].split('_r_')[1]
-        image = rgb.rgb_composer(image_i,image_r,image_g)
-        image = np.asarray(image)
+        """
+        The composed negative, from registry.neg_col_cache when possible: it never changes,
+        augmentation is applied afterwards. The returned array is read-only.
+        """
+        name = registry.cutout_dict_train_neg[img_id]['name']
+        return registry.neg_col_cache.get(name, lambda: compose_neg_col(img_id))
+
+def compose_neg_col(img_id):
+        image_r, calib_r = read_band('negatives', registry.cutout_dict_train_neg, img_id, 'r')
+        image_g, calib_g = read_band('negatives', registry.cutout_dict_train_neg, img_id, 'g')
+        image_i, calib_i = read_band('negatives', registry.cutout_dict_train_neg, img_id, 'i')
+        image = rgb.rgb_composer_arrays(image_i,image_r,image_g,calibs=(calib_i,calib_r,calib_g))
 
         return image
 
@@ -236,56 +348,157 @@ def load_fits_test_col(path, preprocess=preprocess):
           image=((image/255.)-0.5)*2
         
         return image
+
+def load_fits_test_col_batch(paths, preprocess=preprocess, files=None):
+        """
+        load_fits_test_col for a list of r-band paths, composed in one vectorised pass.
+        files optionally maps band file names to their contents, already read from disk.
+        """
+        bands = []
+        for band in ('i', 'r', 'g'):
+            names = [packed_store.band_name(path, band) if band != 'r' else path for path in paths]
+            images, calibs = zip(*[read_fits_band(in_memory(name, files)) for name in names])
+            bands.append((np.stack(images), np.array(calibs)))
+        (image_i, calib_i), (image_r, calib_r), (image_g, calib_g) = bands
+        return preprocess_test_col_batch(image_i, image_r, image_g, (calib_i, calib_r, calib_g), preprocess)
+
+def preprocess_test_col_batch(image_i, image_r, image_g, calibs, preprocess=preprocess):
+        """Colour test images from (N,NX,NY) i, r, g stacks already in memory, as load_fits_test_col_batch makes them."""
+        images=rgb.rgb_composer_batch(image_i,image_r,image_g,calibs=calibs)
+        if preprocess:
+          images=((images/255.)-0.5)*2
+        
+        return images
                 
 
-def buffered_gen_mp(source_gen, buffer_size=2, sleep_time=1):                            
+class _SlotArray(object):
+    """Placeholder for an array stored in a shared-memory slot at byte `offset`."""
+
+    def __init__(self, offset, shape, dtype):
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+
+
+def _to_slot(item, buf, offset=0):
+    """
+    Copies the arrays in `item` (arrays, plain values and lists/tuples of them) into
+    `buf` from `offset` on, returning the item with _SlotArray placeholders and the end
+    offset. With buf=None nothing is copied, which gives the slot size an item needs.
+    """
+    if isinstance(item, np.ndarray):
+        offset = -(-offset // 64) * 64 # keep every array 64-byte aligned
+        if buf is not None:
+            np.ndarray(item.shape, dtype=item.dtype, buffer=buf, offset=offset)[...] = item
+        return _SlotArray(offset, item.shape, item.dtype.str), offset + item.nbytes
+    if isinstance(item, (list, tuple)):
+        placeholders = []
+        for x in item:
+            x, offset = _to_slot(x, buf, offset)
+            placeholders.append(x)
+        return type(item)(placeholders), offset
+    return item, offset
+
+
+def _from_slot(item, buf):
+    """Inverse of _to_slot: replaces the placeholders by NumPy views on `buf`."""
+    if isinstance(item, _SlotArray):
+        return np.ndarray(item.shape, dtype=item.dtype, buffer=buf, offset=item.offset)
+    if isinstance(item, (list, tuple)):
+        return type(item)(_from_slot(x, buf) for x in item)
+    return item
+
+
+def _buffered_generation_process(source_gen, ready, free):
+    slots = []
+    for data in source_gen:
+        _, nbytes = _to_slot(data, None)
+        if not slots:
+            # the consumer sizes the slots on the first item and sends back their names
+            ready.put(('layout', nbytes))
+            slots = [shared_memory.SharedMemory(name=name) for name in free.get()]
+        # we block here until the consumer hands a slot back. There's no point in
+        # generating more data when the buffer is full.
+        slot = free.get()
+        if nbytes > slots[slot].size:
+            ready.put(('pickled', slot, data)) # bigger than the first item, send it the slow way
+        else:
+            ready.put(('slot', slot, _to_slot(data, slots[slot].buf)[0]))
+    ready.put(('done',))
+    for shm in slots:
+        shm.close()
+
+
+def _ready_items(q):
+    try:
+        return q.qsize()
+    except NotImplementedError: # macOS
+        return float('nan')
+
+
+def buffered_gen_mp(source_gen, buffer_size=2, sleep_time=1, stats=None):                            
     """
     Generator that runs a slow source generator in a separate process.
     buffer_size: the maximal number of items to pre-generate (length of the buffer)
+    stats: optional callable, called as stats(ready, buffer_size) whenever an item is
+    taken, with `ready` the number of items already generated and waiting behind it.
+
+    Items travel through a ring of buffer_size+1 preallocated shared-memory slots instead
+    of being pickled through a queue: the producer writes the arrays of an item into a
+    free slot in place, and the consumer yields NumPy views on that slot. A view is only
+    valid until the next item is requested, when its slot goes back to the producer, so
+    copy anything that has to outlive the iteration.
     """
-    buffer = mp.Queue(maxsize=buffer_size)
+    ready = mp.Queue()
+    free = mp.Queue()
+    # start the resource tracker before forking so that producer and consumer share it
+    resource_tracker.ensure_running()
+    process = mp.Process(target=_buffered_generation_process, args=(source_gen, ready, free))
+    process.start()
 
-    def _buffered_generation_process(source_gen, buffer):
+    slots = []
+    held = None
+    producer_exited = False
+    try:
         while True:
-            # we block here when the buffer is full. There's no point in generating more data
-            # when the buffer is full, it only causes extra memory usage and effectively
-            # increases the buffer size by one.
-            while buffer.full():
-                # print "DEBUG: buffer is full, waiting to generate more data."
-                time.sleep(sleep_time)
-
+            if held is not None:
+                free.put(held)
+                held = None
             try:
-                data = next(source_gen)
-            except StopIteration:
-                # print "DEBUG: OUT OF DATA, CLOSING BUFFER"
-                buffer.close() # signal that we're done putting data in the buffer
+                message = ready.get(True, timeout=sleep_time)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+                if producer_exited:
+                    break # no more data is going to come, the producer died without saying so.
+                producer_exited = True # one more pass to pick up whatever it flushed before exiting
+                continue
+
+            if message[0] == 'done':
                 break
-
-            buffer.put(data)
-    
-    process = mp.Process(target=_buffered_generation_process, args=(source_gen, buffer))
-    process.start()
-    
-    while True:
-        try:
-            # yield buffer.get()
-            # just blocking on buffer.get() here creates a problem: when get() is called and the buffer
-            # is empty, this blocks. Subsequently closing the buffer does NOT stop this block.
-            # so the only solution is to periodically time out and try again. That way we'll pick up
-            # on the 'close' signal.
+            if stats is not None and message[0] != 'layout':
+                stats(_ready_items(ready), buffer_size)
+            if message[0] == 'layout':
+                slots = [shared_memory.SharedMemory(create=True, size=max(message[1], 1)) for _ in range(buffer_size + 1)]
+                free.put([shm.name for shm in slots])
+                for slot in range(len(slots)):
+                    free.put(slot)
+            elif message[0] == 'pickled':
+                held = message[1]
+                yield message[2]
+            else:
+                held = message[1]
+                yield _from_slot(message[2], slots[held].buf)
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        for shm in slots:
             try:
-                yield buffer.get(True, timeout=sleep_time)
-            except queue.Empty:
-                if not process.is_alive():
-                    break # no more data is going to come. This is a workaround because the buffer.close() signal does not seem to be reliable.
-
-                # print "DEBUG: queue is empty, waiting..."
-                pass # ignore this, just try again.
-
-        except IOError: # if the buffer has been closed, calling get() on it will raise IOError.
-            # this means that we're done iterating.
-            # print "DEBUG: buffer closed, stopping."
-            break
+                shm.close()
+            except BufferError:
+                pass # the caller still holds views, the mapping goes away with them
+            shm.unlink()
 
 def hms(seconds):
     seconds = np.floor(seconds)
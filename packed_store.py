@@ -0,0 +1,118 @@
+"""
+Packed, memory-mapped cutout store.
+
+Every training class is written once into a single contiguous float32 file
+(<name>.bin) with an offset index (<name>_index.npy) keyed by the ids of the
+cutout dictionaries. Reading a sample is then a slice of an np.memmap instead
+of a FITS open/parse/close, and forked Pool workers share the page cache.
+
+Run this file once after create_training_dic.py to pack the training set.
+"""
+
+import numpy as np
+import os
+import pickle
+from astropy.io import fits
+
+packed_path = 'data/packed/'
+
+index_dtype = np.dtype([('key', 'i8'), ('offset', 'i8'), ('ny', 'i4'), ('nx', 'i4'), ('calib', 'f8')])
+
+_open_stores = {}
+
+
+def band_name(name, band):
+    """Name of the `band` cutout matching an r-band cutout name."""
+    return name.split('_r_')[0]+'_'+band+'_'+name.split('_r_')[1]
+
+
+def pack(names, store_name, path='', out_path=packed_path, transform=None, calibrate=None):
+    """
+    Writes the FITS cutouts in `names` (a dictionary id -> file name) into one
+    float32 file. Unreadable files get an offset of -1 and raise IOError when
+    read back, like fits.getdata would. `transform` is applied to each image
+    before it is written. `calibrate` maps a cutout header to the calibration
+    factor stored alongside it (NaN when not given).
+    """
+    if not os.path.exists(out_path):
+        os.makedirs(out_path)
+    index = np.zeros(len(names), dtype=index_dtype)
+    offset = 0
+    with open(out_path+store_name+'.bin', 'wb') as f:
+        for i, key in enumerate(sorted(names)):
+            index[i]['key'] = key
+            index[i]['calib'] = np.nan
+            try:
+                image, header = fits.getdata(path+names[key], header=True)
+            except IOError:
+                index[i]['offset'] = -1
+                continue
+            if calibrate is not None:
+                index[i]['calib'] = calibrate(header)
+            if transform is not None:
+                image = transform(image)
+            image = np.ascontiguousarray(image, dtype='float32')
+            image.tofile(f)
+            index[i]['offset'] = offset
+            index[i]['ny'], index[i]['nx'] = image.shape
+            offset += image.size
+    np.save(out_path+store_name+'_index.npy', index)
+    return index
+
+
+class PackedStore(object):
+    """Read-only view on a packed cutout file, indexed by cutout id."""
+
+    def __init__(self, store_name, path=packed_path):
+        index = np.load(path+store_name+'_index.npy')
+        self.name = store_name
+        self.index = dict((int(k), (o, ny, nx)) for k, o, ny, nx in index[['key', 'offset', 'ny', 'nx']])
+        if 'calib' in index.dtype.names:
+            self.calibs = dict((int(k), c) for k, c in index[['key', 'calib']] if not np.isnan(c))
+        else:
+            self.calibs = {}
+        if index['offset'].max() >= 0:
+            self.data = np.memmap(path+store_name+'.bin', dtype='float32', mode='r')
+        else:
+            self.data = np.zeros(0, dtype='float32')
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key):
+        offset, ny, nx = self.index[key]
+        if offset < 0:
+            raise IOError('cutout %s is missing from packed store %s' % (key, self.name))
+        return self.data[offset:offset+ny*nx].reshape(ny, nx)
+
+    def calib(self, key):
+        """Calibration factor stored with cutout `key`, or None if it was packed without one."""
+        return self.calibs.get(key)
+
+
+def is_packed(store_name, path=packed_path):
+    return os.path.exists(path+store_name+'_index.npy')
+
+
+def open_store(store_name, path=packed_path):
+    """Returns the (cached) PackedStore `store_name`, or None if it was never packed."""
+    if store_name not in _open_stores:
+        _open_stores[store_name] = PackedStore(store_name, path) if is_packed(store_name, path) else None
+    return _open_stores[store_name]
+
+
+if __name__ == "__main__":
+    import humvi
+    dictionaries = [('lenses', "data/train_dic_lenses.p", ('r', 'g', 'i')),
+                    ('negatives', "data/train_dic_neg.p", ('r', 'g', 'i')),
+                    ('real_lenses', "data/train_dic_real_lenses.p", ('r', 'g', 'i'))]
+    for class_name, dic, bands in dictionaries:
+        cutout_dict = pickle.load(open(dic, "rb"))
+        for band in bands:
+            names = dict((k, band_name(v['name'], band)) for k, v in cutout_dict.items())
+            print("Packing %s_%s" % (class_name, band))
+            pack(names, class_name+'_'+band, calibrate=humvi.calibration_factor)
+
+    cutout_dict = pickle.load(open("data/train_dic_sources.p", "rb"))
+    print("Packing sources")
+    pack(dict((k, v['name']) for k, v in cutout_dict.items()), 'sources', path="data/training/sources/")
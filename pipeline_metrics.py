@@ -0,0 +1,199 @@
+"""
+Throughput metrics of a training run, to tell an input-bound run from a compute-bound one.
+
+A Metrics object collects counters (samples generated and trained, seconds the
+minibatch stream is blocked on the chunk generators, seconds the trainer waits for
+input and spends in the model) and gauges (occupancy of the buffered_gen_mp queues).
+Samples are counted as generated where the chunks are made, in the buffered_gen_mp
+producer processes (see counting), so generation running ahead of or behind
+training shows in the rates.
+MetricsLogger writes their rates every few minibatches to a JSONL or CSV file, and
+serve() exposes them in the Prometheus text format on a local port.
+"""
+
+import collections
+import contextlib
+import csv
+import http.server
+import json
+import multiprocessing as mp
+import threading
+import time
+from keras.callbacks import Callback
+
+
+class Metrics(object):
+    """
+    Thread-safe counters, which only grow, and gauges, which keep their last value.
+    Shared counters can also be added to from processes forked after their creation.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.OrderedDict()
+        self.gauges = collections.OrderedDict()
+        self.shared = collections.OrderedDict()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def shared_counter(self, name):
+        """The multiprocessing.Value of the counter `name`, for processes forked after this call to add to."""
+        with self.lock:
+            if name not in self.shared:
+                self.shared[name] = mp.Value('d', 0.)
+            return self.shared[name]
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Adds the seconds spent in the with block to the counter `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.count(name, time.perf_counter() - start)
+
+    def queue(self, name):
+        """The stats callback of buffered_gen_mp for the queue `name`."""
+        def stats(ready, capacity):
+            self.gauge(name+'_queue_occupancy', ready)
+            self.gauge(name+'_queue_capacity', capacity)
+        return stats
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            for name, value in self.shared.items():
+                counters[name] = counters.get(name, 0) + value.value
+            return counters, dict(self.gauges)
+
+    def prometheus(self, prefix='lensfinder_'):
+        """The metrics in the Prometheus text exposition format."""
+        counters, gauges = self.snapshot()
+        lines = []
+        for name, value in counters.items():
+            lines += ['# TYPE %s%s_total counter' % (prefix, name), '%s%s_total %r' % (prefix, name, float(value))]
+        for name, value in gauges.items():
+            lines += ['# TYPE %s%s gauge' % (prefix, name), '%s%s %r' % (prefix, name, float(value))]
+        return '\n'.join(lines) + '\n'
+
+
+def counting(gen, counter):
+    """
+    Passes the (chunk, chunk_size) items of gen through, adding every chunk_size to the
+    shared counter as soon as the chunk is made - wrap the source generator of a
+    buffered_gen_mp with it to count in the producer.
+    """
+    for item in gen:
+        with counter.get_lock():
+            counter.value += item[1]
+        yield item
+
+
+class MetricsLogger(Callback):
+    """
+    Times the model and the trainer's wait for the next minibatch, and every `every`
+    minibatches writes one row of rates over the interval to `filename` (JSON lines, or
+    CSV if it ends in .csv): samples/s generated and trained, the fraction of the time
+    waiting for input and in the model, the seconds blocked on each generator and the
+    queue gauges.
+    """
+
+    def __init__(self, metrics, filename, every=50):
+        super(MetricsLogger, self).__init__()
+        self.metrics = metrics
+        self.filename = filename
+        self.every = every
+        self.step = 0
+        self.chunk = 0
+        self.batch_start = None
+        self.batch_end = None
+        self.writer = None
+
+    def on_train_begin(self, logs=None):
+        self.file = open(self.filename, 'a')
+        self.last = (time.perf_counter(), self.metrics.snapshot()[0])
+
+    def on_batch_begin(self, batch, logs=None):
+        self.batch_start = time.perf_counter()
+        if self.batch_end is not None:
+            self.metrics.count('input_wait_seconds', self.batch_start - self.batch_end)
+
+    def on_batch_end(self, batch, logs=None):
+        self.batch_end = time.perf_counter()
+        self.metrics.count('model_seconds', self.batch_end - self.batch_start)
+        self.metrics.count('trained_samples', (logs or {}).get('size', 0))
+        self.step += 1
+        if self.step % self.every == 0:
+            self.write()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.chunk = epoch + 1
+
+    def on_train_end(self, logs=None):
+        if self.step % self.every:
+            self.write()
+        self.file.close()
+
+    def write(self):
+        now = time.perf_counter()
+        counters, gauges = self.metrics.snapshot()
+        last_time, last = self.last
+        self.last = (now, counters)
+        elapsed = now - last_time
+
+        def delta(name):
+            return counters.get(name, 0) - last.get(name, 0)
+
+        row = collections.OrderedDict([
+            ('time', time.time()),
+            ('step', self.step),
+            ('chunk', self.chunk),
+            ('generated_samples_per_s', delta('generated_samples') / elapsed),
+            ('trained_samples_per_s', delta('trained_samples') / elapsed),
+            ('input_wait_fraction', delta('input_wait_seconds') / elapsed),
+            ('model_fraction', delta('model_seconds') / elapsed),
+            ('next_pos_seconds', delta('next_pos_seconds')),
+            ('next_neg_seconds', delta('next_neg_seconds')),
+            ('bound', 'input' if delta('input_wait_seconds') > delta('model_seconds') else 'compute'),
+        ])
+        row.update(sorted(gauges.items()))
+        if self.filename.endswith('.csv'):
+            if self.writer is None:
+                self.writer = csv.DictWriter(self.file, list(row), restval='', extrasaction='ignore')
+                if self.file.tell() == 0:
+                    self.writer.writeheader()
+            self.writer.writerow(row)
+        else:
+            self.file.write(json.dumps(row)+'\n')
+        self.file.flush()
+
+
+def serve(metrics, port, host='127.0.0.1'):
+    """Serves metrics.prometheus() at http://host:port/metrics from a daemon thread. Returns the server."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass # no line on stderr per scrape
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    return server
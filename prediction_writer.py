@@ -0,0 +1,112 @@
+"""
+Streaming, resumable output for predict mode.
+
+Every scored chunk is written to its own column file (<out_dir>/chunk_<n>.npz with the
+columns path, score and tta_scores) as soon as it is done, and only then recorded in the
+done-manifest (<out_dir>/done.txt). A run that stops part way loses at most the chunk it
+was scoring: the next run reads the manifest and skips every path already scored.
+The number of test-time symmetries (the width of tta_scores) is recorded in
+<out_dir>/tta_transforms.txt, and a run with a different number refuses to resume there.
+"""
+
+import os
+import numpy as np
+
+
+class PredictionWriter(object):
+
+    manifest_name = 'done.txt'
+    width_name = 'tta_transforms.txt'
+
+    def __init__(self, out_dir, num_transforms=None):
+        """
+        num_transforms is the width of the tta_scores this run writes; None takes it from
+        the first chunk written. A ValueError is raised if out_dir holds another width.
+        """
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        self.out_dir = out_dir
+        self.manifest = os.path.join(out_dir, self.manifest_name)
+        self.chunks = []
+        if os.path.exists(self.manifest):
+            with open(self.manifest) as f:
+                self.chunks = [line.strip() for line in f if line.strip()]
+        self.num_transforms = self._recorded_width()
+        if num_transforms is not None:
+            self._check_width(num_transforms)
+
+    def done_paths(self):
+        """Paths already scored by this or an earlier run."""
+        done = set()
+        for chunk in self.chunks:
+            done.update(self._load(chunk)['path'].tolist())
+        return done
+
+    def write(self, paths, scores, tta_scores=None):
+        """
+        Records one chunk: the scores (N,) of `paths` and, optionally, the (N, num_transforms)
+        score of every test-time symmetry. The chunk file is complete on disk before the
+        manifest lists it.
+        """
+        paths = np.asarray(paths, dtype=str)
+        scores = np.asarray(scores, dtype='float32')
+        if tta_scores is None:
+            tta_scores = scores[:, None]
+        tta_scores = np.asarray(tta_scores, dtype='float32')
+        self._check_width(tta_scores.shape[1])
+        name = 'chunk_%06d.npz' % len(self.chunks)
+        filename = os.path.join(self.out_dir, name)
+        with open(filename+'.tmp', 'wb') as f:
+            np.savez(f, path=paths, score=scores, tta_scores=tta_scores)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(filename+'.tmp', filename)
+        with open(self.manifest, 'a') as f:
+            f.write(name+'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.chunks.append(name)
+
+    def read(self, columns=('path', 'score', 'tta_scores')):
+        """All the chunks written so far, as one dictionary of `columns`."""
+        chunks = [self._load(chunk) for chunk in self.chunks]
+        empty = {'path': np.zeros(0, dtype=str), 'score': np.zeros(0, dtype='float32'),
+                 'tta_scores': np.zeros((0, self.num_transforms or 1), dtype='float32')}
+        if not chunks:
+            return dict((column, empty[column]) for column in columns)
+        return dict((column, np.concatenate([chunk[column] for chunk in chunks]))
+                    for column in columns)
+
+    def scores_for(self, paths):
+        """Scores of `paths`, in that order (NaN for paths not scored yet)."""
+        columns = self.read(('path', 'score'))
+        scores = dict(zip(columns['path'].tolist(), columns['score'].tolist()))
+        return np.array([scores.get(path, np.nan) for path in paths], dtype='float32')
+
+    def _recorded_width(self):
+        filename = os.path.join(self.out_dir, self.width_name)
+        if os.path.exists(filename):
+            with open(filename) as f:
+                return int(f.read())
+        if self.chunks:
+            # written before the width was recorded: record the width of its chunks
+            return self._record_width(self._load(self.chunks[0])['tta_scores'].shape[1])
+        return None
+
+    def _record_width(self, num_transforms):
+        filename = os.path.join(self.out_dir, self.width_name)
+        with open(filename+'.tmp', 'w') as f:
+            f.write('%d\n' % num_transforms)
+        os.replace(filename+'.tmp', filename)
+        return num_transforms
+
+    def _check_width(self, num_transforms):
+        if self.num_transforms is None:
+            self.num_transforms = self._record_width(num_transforms)
+        elif num_transforms != self.num_transforms:
+            raise ValueError('%s holds predictions with %d test-time symmetries, this run makes %d: '
+                             'score into another directory or remove it' % (self.out_dir, self.num_transforms, num_transforms))
+
+    def _load(self, chunk):
+        with np.load(os.path.join(self.out_dir, chunk)) as data:
+            return dict((column, data[column]) for column in data.files)
@@ -0,0 +1,166 @@
+"""
+Post-training int8 quantisation of a trained model for CPU inference. Run as
+
+    python quantize.py [model_name]
+
+It rebuilds the model of cnn.py, loads <model_name>_weights_only.h5 and converts it
+with TensorFlow Lite: weights and activations become int8, their ranges calibrated on
+a sample of training chunks. Only the input and output stay float, so the quantised
+model reads the same 0-255 images as the Keras model. The result is written to
+<model_name>_int8.tflite, which predict and scan modes use when cnn.tflite_model
+points at it, and it is compared with the float model on the held-out validation
+cutouts (see heldout_cutouts): accuracy delta and images per second.
+"""
+
+import os
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+import augmentation as ra
+
+
+def sample_chunks(num_samples, nbands=1, seed=None, input_sizes=[(101, 101)], augmentation_params=ra.default_augmentation_params,
+                  stretch='sqrt', normalize=True, resize=False, range_min=0.02, range_max=0.30):
+    """
+    num_samples training images, half positives and half negatives, and their labels,
+    made by the training generators from the random streams of `seed`. For single-band
+    images pass the training run's stretch, normalize, resize and lens-strength range
+    (range_min, range_max), so that the sample has the distribution the model was trained on.
+    """
+    half = num_samples // 2
+    if nbands == 3:
+        gens = [(ra.realtime_augmented_data_gen_pos_col, {}), (ra.realtime_augmented_data_gen_neg_col, {})]
+    else:
+        single_band = {'stretch': stretch, 'normalize': normalize, 'resize': resize}
+        gens = [(ra.realtime_augmented_data_gen_pos, dict(single_band, range_min=range_min, range_max=range_max)),
+                (ra.realtime_augmented_data_gen_neg, single_band)]
+    X, y = [], []
+    for gen, kwargs in gens:
+        chunk, _ = next(gen(num_chunks=1, chunk_size=half, target_sizes=input_sizes, augmentation_params=augmentation_params, seed=seed, **kwargs))
+        X.append(chunk[0])
+        y.append(chunk[-1])
+    return np.concatenate(X), np.concatenate(y)
+
+
+def training_sample(num_samples, seed):
+    """sample_chunks with the data parameters of cnn.py, i.e. of the training run."""
+    import cnn
+    return sample_chunks(num_samples, cnn.nbands, seed, cnn.input_sizes, cnn.default_augmentation_params,
+                         cnn.stretch, cnn.normalize, cnn.resize, cnn.range_min, cnn.range_max)
+
+
+def heldout_cutouts(path_val, nbands=1, input_sizes=[(101, 101)], num_processes=None, stretch='sqrt'):
+    """
+    The validation cutouts under path_val and their labels: lenses/ (1) and negatives/ (0)
+    hold r-band files named as the test cutouts, with g and i next to them for 3 bands.
+    They go through the fixed test generators, so they are read as predict mode reads
+    them (single-band with `stretch`), and none of them is a training image.
+    """
+    if nbands == 3:
+        gen = ra.realtime_fixed_augmented_data_test_col
+        kwargs = {}
+    else:
+        gen = ra.realtime_fixed_augmented_data_test
+        kwargs = {'stretch': stretch}
+    X, y = [], []
+    for label, folder in ((1, 'lenses'), (0, 'negatives')):
+        paths = sorted(ra.get_test_data(os.path.join(path_val, folder, '')))
+        if not paths:
+            raise IOError('no held-out cutouts in %s' % os.path.join(path_val, folder))
+        for chunk, _ in gen(target_sizes=input_sizes, test_paths=paths, num_processes=num_processes, **kwargs):
+            X.append(chunk[0])
+            y.append(np.full(len(chunk[0]), label))
+    return np.concatenate(X), np.concatenate(y)
+
+
+def convert(model, calibration, path, session=None):
+    """
+    Converts the Keras `model` to an int8 TFLite model at `path`, calibrating the
+    activation ranges on the (N,H,W,C) images `calibration`. Returns the model bytes.
+    """
+    session = session or K.get_session()
+    converter = tf.lite.TFLiteConverter.from_session(session, model.inputs, model.outputs)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    def representative_dataset():
+        for image in calibration:
+            yield [image[None].astype('float32')]
+
+    converter.representative_dataset = representative_dataset
+    tflite_model = converter.convert()
+    with open(path, 'wb') as f:
+        f.write(tflite_model)
+    return tflite_model
+
+
+class QuantizedModel(object):
+    """A TFLite model with the predict(X, batch_size) of a Keras model, as tta.predict_tta uses it."""
+
+    def __init__(self, path, num_threads=None):
+        kwargs = {} if num_threads is None else {'num_threads': num_threads}
+        self.interpreter = tf.lite.Interpreter(model_path=path, **kwargs)
+        self.input = self.interpreter.get_input_details()[0]['index']
+        self.output = self.interpreter.get_output_details()[0]['index']
+        self.shape = None
+
+    def predict(self, X, batch_size=32, verbose=0):
+        preds = []
+        for start in range(0, len(X), batch_size):
+            batch = np.ascontiguousarray(X[start:start + batch_size], dtype='float32')
+            if batch.shape != self.shape:
+                # the last batch of a chunk is smaller
+                self.interpreter.resize_tensor_input(self.input, batch.shape)
+                self.interpreter.allocate_tensors()
+                self.shape = batch.shape
+            self.interpreter.set_tensor(self.input, batch)
+            self.interpreter.invoke()
+            preds.append(self.interpreter.get_tensor(self.output).copy())
+        return np.concatenate(preds)
+
+
+def evaluate(model, X, y, batch_size=32):
+    """Scores, accuracy at a 0.5 threshold and images per second of `model` on X, y."""
+    model.predict(X[:batch_size], batch_size=batch_size) # warm up
+    start = time.time()
+    scores = model.predict(X, batch_size=batch_size)[:, 0]
+    elapsed = time.time() - start
+    return scores, np.mean((scores > 0.5) == y), len(X) / elapsed
+
+
+def compare(model, quantized, X, y, batch_size=32):
+    """The float Keras model against its quantised version on the held-out X, y."""
+    float_scores, float_accuracy, float_rate = evaluate(model, X, y, batch_size)
+    int8_scores, int8_accuracy, int8_rate = evaluate(quantized, X, y, batch_size)
+    return {'float_accuracy': float_accuracy,
+            'int8_accuracy': int8_accuracy,
+            'accuracy_delta': int8_accuracy - float_accuracy,
+            'max_score_difference': float(np.max(np.abs(int8_scores - float_scores))),
+            'float_images_per_s': float_rate,
+            'int8_images_per_s': int8_rate,
+            'speedup': int8_rate / float_rate}
+
+
+def main(model_name=None, num_calibration=512, batch_size=32, calibration_seed=1, path_val=None):
+    import cnn
+    model_name = model_name or cnn.model_name
+    path_val = path_val or cnn.path_val
+    model = cnn.call_model()
+    model.load_weights(model_name+'_weights_only.h5')
+
+    X_calibration, _ = training_sample(num_calibration, calibration_seed)
+    path = model_name+'_int8.tflite'
+    convert(model, X_calibration, path)
+    print('wrote', path)
+
+    X, y = heldout_cutouts(path_val, cnn.nbands, cnn.input_sizes, cnn.num_processes, cnn.stretch)
+    results = compare(model, QuantizedModel(path), X, y, batch_size)
+    for key, value in sorted(results.items()):
+        print('%s: %s' % (key, value))
+    return results
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:2])
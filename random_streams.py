@@ -0,0 +1,37 @@
+"""
+Seeded, independent random streams for the training-data generators.
+
+Every random draw of a generator and of its pool workers comes from a counter-based Philox
+generator whose key is derived with SeedSequence from the run's seed and a stream key:
+(generator, chunk) for what a generator draws for a whole chunk (which samples to use) and
+(generator, chunk, sample) for everything drawn for one sample (augmentation, mock-lens
+parameters). Forked workers therefore never share random state, a sample does not depend
+on which worker makes it or in which order, and chunk n of a run can be regenerated
+exactly from the run's seed.
+"""
+
+import numpy as np
+
+# stream ids of the generators, so that e.g. chunk n of the positives and of the negatives differ
+NEG, POS, NEG_COL, POS_COL = range(4)
+
+
+class RandomStreams(object):
+    """The random streams of one run. With seed=None a fresh seed is drawn and kept in .seed."""
+
+    def __init__(self, seed=None):
+        self.seed = np.random.SeedSequence(seed).entropy
+
+    def generator(self, *key):
+        """The np.random.Generator of stream `key` (a tuple of non-negative ints)."""
+        return np.random.Generator(np.random.Philox(np.random.SeedSequence(self.seed, spawn_key=key)))
+
+    def __repr__(self):
+        return 'RandomStreams(seed=%d)' % self.seed
+
+
+def generator(streams, key):
+    """streams.generator(*key), or an unseeded generator when there are no streams."""
+    if streams is None:
+        return np.random.default_rng()
+    return streams.generator(*key)
@@ -7,10 +7,12 @@ from keras.layers import (
     Activation,
     Dense,
     Flatten,
-    GaussianNoise
+    GaussianNoise,
+    Lambda
 )
 from keras.layers.convolutional import (
     Conv2D,
+    SeparableConv2D,
     MaxPooling2D,
     AveragePooling2D
 )
@@ -27,6 +29,22 @@ def _bn_relu(input):
     return Activation("relu")(norm)
 
 
+def _conv(filters, kernel_size, strides, padding, kernel_initializer, kernel_regularizer, separable=False):
+    """Conv2D, or with separable=True a depthwise-separable SeparableConv2D unless the kernel is 1 X 1
+    """
+    if separable and tuple(kernel_size) != (1, 1):
+        return SeparableConv2D(filters=filters, kernel_size=kernel_size,
+                               strides=strides, padding=padding,
+                               depthwise_initializer=kernel_initializer,
+                               pointwise_initializer=kernel_initializer,
+                               depthwise_regularizer=kernel_regularizer,
+                               pointwise_regularizer=kernel_regularizer)
+    return Conv2D(filters=filters, kernel_size=kernel_size,
+                  strides=strides, padding=padding,
+                  kernel_initializer=kernel_initializer,
+                  kernel_regularizer=kernel_regularizer)
+
+
 def _conv_bn_relu(**conv_params):
     """Helper to build a conv -> BN -> relu block
     """
@@ -57,13 +75,12 @@ def _bn_relu_conv(**conv_params):
     kernel_initializer = conv_params.setdefault("kernel_initializer", "he_normal")
     padding = conv_params.setdefault("padding", "same")
     kernel_regularizer = conv_params.setdefault("kernel_regularizer", l2(1.e-4))
+    separable = conv_params.setdefault("separable", False)
 
     def f(input):
         activation = _bn_relu(input)
-        return Conv2D(filters=filters, kernel_size=kernel_size,
-                      strides=strides, padding=padding,
-                      kernel_initializer=kernel_initializer,
-                      kernel_regularizer=kernel_regularizer)(activation)
+        return _conv(filters, kernel_size, strides, padding, kernel_initializer,
+                     kernel_regularizer, separable)(activation)
 
     return f
 
@@ -108,7 +125,7 @@ def _residual_block(block_function, filters, repetitions, is_first_layer=False):
     return f
 
 
-def basic_block(filters, init_strides=(1, 1), is_first_block_of_first_layer=False):
+def basic_block(filters, init_strides=(1, 1), is_first_block_of_first_layer=False, separable=False):
     """Basic 3 X 3 convolution blocks for use on resnets with layers <= 34.
     Follows improved proposed scheme in http://arxiv.org/pdf/1603.05027v2.pdf
     """
@@ -116,21 +133,25 @@ def basic_block(filters, init_strides=(1, 1), is_first_block_of_first_layer=Fals
 
         if is_first_block_of_first_layer:
             # don't repeat bn->relu since we just did bn->relu->maxpool
-            conv1 = Conv2D(filters=filters, kernel_size=(3, 3),
-                           strides=init_strides,
-                           padding="same",
-                           kernel_initializer="he_normal",
-                           kernel_regularizer=l2(1e-4))(input)
+            conv1 = _conv(filters, (3, 3), init_strides, "same", "he_normal",
+                          l2(1e-4), separable)(input)
         else:
             conv1 = _bn_relu_conv(filters=filters, kernel_size=(3, 3),
-                                  strides=init_strides)(input)
+                                  strides=init_strides, separable=separable)(input)
 
-        residual = _bn_relu_conv(filters=filters, kernel_size=(3, 3))(conv1)
+        residual = _bn_relu_conv(filters=filters, kernel_size=(3, 3), separable=separable)(conv1)
         return _shortcut(input, residual)
 
     return f
 
 
+def separable_basic_block(filters, init_strides=(1, 1), is_first_block_of_first_layer=False):
+    """basic_block with depthwise-separable 3 X 3 convolutions: about 8x fewer
+    multiply-adds per block at 64 filters and more, for CPU inference.
+    """
+    return basic_block(filters, init_strides, is_first_block_of_first_layer, separable=True)
+
+
 def bottleneck(filters, init_strides=(1, 1), is_first_block_of_first_layer=False):
     """Bottleneck architecture for > 34 layer resnet.
     Follows improved proposed scheme in http://arxiv.org/pdf/1603.05027v2.pdf
@@ -182,7 +203,8 @@ def _get_block(identifier):
 
 class ResnetBuilder(object):
     @staticmethod
-    def build(input_shape, num_outputs, block_fn, repetitions):
+    def build(input_shape, num_outputs, block_fn, repetitions, rescale=None, width_multiplier=1.0,
+              stem_filters=None, stem_kernel_size=(7, 7), stem_strides=(2, 2), stem_pool=True, separable=False):
         """Builds a custom ResNet like architecture.
         Args:
             input_shape: The input shape in the form (nb_channels, nb_rows, nb_cols)
@@ -191,6 +213,14 @@ class ResnetBuilder(object):
                 The original paper used basic_block for layers < 50
             repetitions: Number of repetitions of various block units.
                 At each block unit, the number of filters are doubled and the input size is halved
+            rescale: Optional (scale, offset). The model then takes raw (e.g. uint8 0-255) images
+                and computes images * scale - offset in-graph, in a weightless Lambda layer.
+            width_multiplier: Scales the filters of every block (64, 128, 256, 512 at 1.0).
+            stem_filters: Filters of the stem convolution, by default those of the first block.
+            stem_kernel_size, stem_strides, stem_pool: The stem convolution and whether a
+                3 X 3 stride 2 max pooling follows it. The defaults are the ImageNet stem; on
+                101 X 101 cutouts e.g. a (3, 3) stride (1, 1) stem keeps more resolution.
+            separable: Use `separable_basic_block` for `basic_block`.
         Returns:
             The keras `Model`.
         """
@@ -204,14 +234,24 @@ class ResnetBuilder(object):
 
         # Load function from str if needed.
         block_fn = _get_block(block_fn)
+        if separable:
+            if block_fn is not basic_block:
+                raise ValueError('separable blocks are only available for basic_block')
+            block_fn = separable_basic_block
+        base_filters = max(8, int(round(64 * width_multiplier)))
 
         input = Input(shape=input_shape)
+        x = input
+        if rescale is not None:
+            scale, offset = rescale
+            x = Lambda(lambda images: images * scale - offset, name='rescale')(input)
         #Gauss = GaussianNoise(0.01)(input)
-        conv1 = _conv_bn_relu(filters=64, kernel_size=(7, 7), strides=(2, 2))(input)
-        pool1 = MaxPooling2D(pool_size=(3, 3), strides=(2, 2), padding="same")(conv1)
+        conv1 = _conv_bn_relu(filters=stem_filters or base_filters, kernel_size=stem_kernel_size, strides=stem_strides)(x)
+        if stem_pool:
+            conv1 = MaxPooling2D(pool_size=(3, 3), strides=(2, 2), padding="same")(conv1)
 
-        block = pool1
-        filters = 64
+        block = conv1
+        filters = base_filters
         for i, r in enumerate(repetitions):
             block = _residual_block(block_fn, filters=filters, repetitions=r, is_first_layer=(i == 0))(block)
             filters *= 2
@@ -231,21 +271,25 @@ class ResnetBuilder(object):
         return model
 
     @staticmethod
-    def build_resnet_18(input_shape, num_outputs):
-        return ResnetBuilder.build(input_shape, num_outputs, basic_block, [2, 2, 2, 2])
+    def build_resnet_10(input_shape, num_outputs, **kwargs):
+        return ResnetBuilder.build(input_shape, num_outputs, basic_block, [1, 1, 1, 1], **kwargs)
+
+    @staticmethod
+    def build_resnet_18(input_shape, num_outputs, **kwargs):
+        return ResnetBuilder.build(input_shape, num_outputs, basic_block, [2, 2, 2, 2], **kwargs)
 
     @staticmethod
-    def build_resnet_34(input_shape, num_outputs):
-        return ResnetBuilder.build(input_shape, num_outputs, basic_block, [3, 4, 6, 3])
+    def build_resnet_34(input_shape, num_outputs, **kwargs):
+        return ResnetBuilder.build(input_shape, num_outputs, basic_block, [3, 4, 6, 3], **kwargs)
 
     @staticmethod
-    def build_resnet_50(input_shape, num_outputs):
-        return ResnetBuilder.build(input_shape, num_outputs, bottleneck, [3, 4, 6, 3])
+    def build_resnet_50(input_shape, num_outputs, **kwargs):
+        return ResnetBuilder.build(input_shape, num_outputs, bottleneck, [3, 4, 6, 3], **kwargs)
 
     @staticmethod
-    def build_resnet_101(input_shape, num_outputs):
-        return ResnetBuilder.build(input_shape, num_outputs, bottleneck, [3, 4, 23, 3])
+    def build_resnet_101(input_shape, num_outputs, **kwargs):
+        return ResnetBuilder.build(input_shape, num_outputs, bottleneck, [3, 4, 23, 3], **kwargs)
 
     @staticmethod
-    def build_resnet_152(input_shape, num_outputs):
-        return ResnetBuilder.build(input_shape, num_outputs, bottleneck, [3, 8, 36, 3])
+    def build_resnet_152(input_shape, num_outputs, **kwargs):
+        return ResnetBuilder.build(input_shape, num_outputs, bottleneck, [3, 8, 36, 3], **kwargs)
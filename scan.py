@@ -0,0 +1,152 @@
+"""
+Sliding-window scan of full coadd tiles.
+
+The r, g and i tiles are memory-mapped, and windows of the cutout size are cut on a
+regular stride (or around catalogue positions) straight from the maps. They get the same
+preprocessing as the test cutouts and are fed to the model in batches, without writing
+any cutout file. Overlapping windows that fire on the same object are merged by greedy
+non-maximum suppression.
+"""
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+import humvi
+import load_data
+import augmentation as ra
+import packed_store
+import tta
+
+window_size = 101
+
+
+class Tile(object):
+    """A coadd tile, band by band: memory-mapped images, HumVI calibration factors and the WCS."""
+
+    def __init__(self, path_r, bands=('i', 'r', 'g')):
+        self.path = path_r
+        self.bands = bands
+        self.images = {}
+        self.calibs = {}
+        self._hdulists = []
+        for band in bands:
+            hdulist = fits.open(path_r if band == 'r' else packed_store.band_name(path_r, band), memmap=True)
+            self._hdulists.append(hdulist)
+            self.images[band] = hdulist[-1].data
+            self.calibs[band] = humvi.calibration_factor(hdulist[-1].header)
+            if band == 'r':
+                self.wcs = WCS(hdulist[-1].header)
+        self.shape = self.images['r'].shape
+        for band in bands:
+            if self.images[band].shape != self.shape:
+                raise ValueError('%s: the %s band is %s, the r band %s' % (path_r, band, self.images[band].shape, self.shape))
+
+    def close(self):
+        for hdulist in self._hdulists:
+            hdulist.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def grid_corners(shape, size=window_size, stride=50):
+    """(N,2) array of the (row, column) lower corners of windows covering the whole image."""
+    def starts(length):
+        last = length - size
+        if last < 0:
+            return np.zeros(0, dtype=int)
+        s = np.arange(0, last + 1, stride)
+        return s if s[-1] == last else np.append(s, last)
+    rows, columns = np.meshgrid(starts(shape[0]), starts(shape[1]), indexing='ij')
+    return np.column_stack((rows.ravel(), columns.ravel()))
+
+
+def catalogue_corners(tile, ra, dec, size=window_size):
+    """
+    Corners of the windows centred on the catalogue positions (degrees) and the indices of
+    the positions they belong to; positions whose window is not fully inside the tile are left out.
+    """
+    columns, rows = tile.wcs.all_world2pix(np.asarray(ra, dtype=float), np.asarray(dec, dtype=float), 0)
+    pixels = np.column_stack((rows, columns))
+    # positions the projection cannot map (e.g. the far side of the sky) come back as NaN
+    pixels[~np.isfinite(pixels)] = -size
+    corners = np.round(pixels).astype(int) - size // 2
+    inside = np.all((corners >= 0) & (corners <= np.array(tile.shape) - size), axis=1)
+    return corners[inside], np.flatnonzero(inside)
+
+
+def extract_windows(image, corners, size=window_size):
+    """(N,size,size) float32 copy of the windows of `image` at `corners`, in native byte order."""
+    windows = np.lib.stride_tricks.sliding_window_view(image, (size, size))
+    return np.asarray(windows[corners[:, 0], corners[:, 1]], dtype='float32')
+
+
+def preprocess_windows(tile, corners, nbands=3, size=window_size, stretch='sqrt'):
+    """The windows at `corners` preprocessed exactly like the test cutouts of that size (single-band: with `stretch`)."""
+    if nbands == 3:
+        image_i, image_r, image_g = [extract_windows(tile.images[band], corners, size) for band in ('i', 'r', 'g')]
+        calibs = [tile.calibs[band] for band in ('i', 'r', 'g')]
+        return load_data.preprocess_test_col_batch(image_i, image_r, image_g, calibs).astype('float32')
+    windows = extract_windows(tile.images['r'], corners, size)
+    # blank and masked windows (all 0 or NaN at the tile edges) stay 0 rather than NaN
+    np.nan_to_num(windows, copy=False, nan=0., posinf=0., neginf=0.)
+    images = np.repeat(ra.stretch_chunk(windows[:, ::-1, :, None], stretch), 3, axis=3) # flipped, as preprocess_test does
+    if load_data.preprocess:
+        images = ((images/255.)-0.5)*2
+    return images
+
+
+def merge_detections(centres, scores, radius=50):
+    """
+    Greedy non-maximum suppression: keeps the highest scoring detection and drops every
+    other detection within `radius` pixels of it, then repeats. Returns the kept indices.
+    """
+    order = np.argsort(scores)[::-1]
+    centres = np.asarray(centres, dtype=float)
+    suppressed = np.zeros(len(scores), dtype=bool)
+    keep = []
+    for i in order:
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        suppressed |= np.sum((centres - centres[i]) ** 2, axis=1) <= radius ** 2
+    return np.array(keep, dtype=int)
+
+
+def scan_tile(model, path_r, nbands=3, stride=50, ra=None, dec=None, batch_size=512, threshold=0.5,
+              merge_radius=50, num_transforms=1, reduce='mean', size=window_size, stretch='sqrt'):
+    """
+    Scores the windows of the tile whose r-band image is path_r - on a grid of the given
+    stride, or centred on the catalogue positions ra, dec - and returns the detections
+    above threshold as a structured array (row, column, ra, dec, score), centres in
+    0-based pixels of the tile. With a stride, detections closer than merge_radius pixels
+    are merged into the highest scoring one. The windows go to the model as 0-255
+    images, like the training chunks: the model rescales them. Single-band windows get
+    `stretch`, which must be the one the model was trained with.
+    """
+    bands = ('i', 'r', 'g') if nbands == 3 else ('r',)
+    with Tile(path_r, bands) as tile:
+        if ra is not None:
+            corners, _ = catalogue_corners(tile, ra, dec, size)
+        else:
+            corners = grid_corners(tile.shape, size, stride)
+        scores = np.zeros(len(corners), dtype='float32')
+        for start in range(0, len(corners), batch_size):
+            X = preprocess_windows(tile, corners[start:start + batch_size], nbands, size, stretch)
+            scores[start:start + batch_size] = tta.predict_tta(model, X, num_transforms=num_transforms, reduce=reduce)[:, 0]
+
+        centres = corners + size // 2
+        hits = np.flatnonzero(scores >= threshold)
+        if ra is None and len(hits):
+            hits = hits[merge_detections(centres[hits], scores[hits], merge_radius)]
+        world = tile.wcs.all_pix2world(centres[hits, 1], centres[hits, 0], 0) if len(hits) else (np.zeros(0), np.zeros(0))
+
+    detections = np.zeros(len(hits), dtype=[('row', 'i8'), ('column', 'i8'), ('ra', 'f8'), ('dec', 'f8'), ('score', 'f4')])
+    detections['row'] = centres[hits, 0]
+    detections['column'] = centres[hits, 1]
+    detections['ra'], detections['dec'] = world
+    detections['score'] = scores[hits]
+    return detections
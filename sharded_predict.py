@@ -0,0 +1,155 @@
+"""
+Predict mode across many cores: the test set is split into contiguous shards, one per
+worker process.
+
+One Keras model in one process does not keep a many-core node busy at these batch
+sizes. Instead every worker is a fresh (spawned) process with a fixed number of threads,
+pinned to its own cores where the machine has enough of them. It builds the model and
+loads the weights once, reads and scores its shard with the usual test generators and
+test-time augmentation, and sends back the scores of every chunk. The parent records
+each chunk as it arrives (in a PredictionWriter, so an interrupted run resumes) and puts
+the scores back in input order.
+"""
+
+import os
+import queue
+import traceback
+import multiprocessing as mp
+import numpy as np
+
+# read by OpenMP, MKL, OpenBLAS and TensorFlow when a worker imports them
+thread_variables = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS')
+
+
+def shards(num_items, num_shards):
+    """num_shards contiguous (start, stop) ranges over num_items, their lengths differing by at most one."""
+    bounds = [num_items * k // num_shards for k in range(num_shards + 1)]
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+def worker_cores(num_workers, threads):
+    """The cores of each worker (threads each), or None when this process may not use that many."""
+    if not hasattr(os, 'sched_getaffinity'):
+        return None
+    available = sorted(os.sched_getaffinity(0))
+    if len(available) < num_workers * threads:
+        return None
+    return [available[k * threads:(k + 1) * threads] for k in range(num_workers)]
+
+
+def _thread_environment(threads):
+    environment = dict((name, str(threads)) for name in thread_variables)
+    environment['TF_NUM_INTEROP_THREADS'] = '1'
+    return environment
+
+
+def pin_threads(threads, cores=None):
+    """Limits this process to `threads` threads (and to `cores`), for the Keras session too."""
+    if cores is not None:
+        os.sched_setaffinity(0, cores)
+    os.environ.update(_thread_environment(threads))
+    import tensorflow as tf
+    from keras import backend as K
+    K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=1)))
+
+
+def _score_shard(shard, start, paths, options, results):
+    """Worker: scores paths (the shard starting at `start`), sending every chunk to `results`."""
+    try:
+        # a spawned process spawns its children too, but the loader pipeline hands them generators: fork
+        mp.set_start_method('fork', force=True)
+        pin_threads(options['threads'], options['cores'])
+        import cnn
+        import augmentation as ra
+        import load_data
+        import tta
+        kwargs = dict(target_sizes=options['input_sizes'], test_paths=paths, num_processes=options['num_processes'],
+                      io_threads=options['io_threads'], io_depth=options['io_depth'])
+        if options['nbands'] == 3:
+            gen = ra.realtime_fixed_augmented_data_test_col(**kwargs)
+        else:
+            gen = ra.realtime_fixed_augmented_data_test(stretch=options['stretch'], **kwargs)
+        chunks = load_data.buffered_gen_mp(gen, buffer_size=2)
+        model = cnn.load_inference_model(cnn.call_model(), options['model_name'], num_threads=options['threads'])
+        scored = 0
+        for chunk, _ in chunks:
+            X = chunk[0]
+            preds, tta_preds = tta.predict_tta(model, X, num_transforms=options['num_transforms'], reduce=options['reduce'], return_all=True)
+            results.put(('chunk', shard, start + scored, preds[:, 0], tta_preds[:, :, 0].T))
+            scored += len(X)
+        results.put(('done', shard, None, None, None))
+    except BaseException:
+        results.put(('error', shard, traceback.format_exc(), None, None))
+
+
+def predict_sharded(paths, num_workers, model_name, nbands=1, input_sizes=[(101, 101)], num_transforms=4, reduce='mean',
+                    threads=None, num_processes=1, io_threads=4, io_depth=8, writer=None, poll=1., stretch='sqrt'):
+    """
+    Scores the test cutouts `paths` with num_workers processes, each with `threads` threads
+    (None: the available cores split evenly) and num_processes preprocessing helpers,
+    scoring a contiguous shard with the model of cnn.load_inference_model(model_name)
+    (single-band cutouts stretched with `stretch`).
+    Every chunk goes to writer.write as soon as it is scored, if a writer is given.
+    Returns the (N,) scores and (N, num_transforms) symmetry scores, in the order of paths.
+    """
+    paths = list(paths)
+    scores = np.full(len(paths), np.nan, dtype='float32')
+    tta_scores = np.full((len(paths), num_transforms), np.nan, dtype='float32')
+    ranges = shards(len(paths), num_workers)
+    if not ranges:
+        return scores, tta_scores
+    if threads is None:
+        threads = max(1, len(os.sched_getaffinity(0)) // len(ranges)) if hasattr(os, 'sched_getaffinity') else max(1, os.cpu_count() // len(ranges))
+    cores = worker_cores(len(ranges), threads) or [None] * len(ranges)
+
+    # spawned, not forked: the workers must not inherit this process's TensorFlow state or
+    # thread pools, and they take the thread limits from the environment when they start
+    context = mp.get_context('spawn')
+    results = context.Queue()
+    workers = []
+    saved = dict((name, os.environ.get(name)) for name in _thread_environment(threads))
+    os.environ.update(_thread_environment(threads))
+    try:
+        for shard, (start, stop) in enumerate(ranges):
+            options = {'threads': threads, 'cores': cores[shard], 'model_name': model_name, 'nbands': nbands,
+                       'input_sizes': input_sizes, 'num_transforms': num_transforms, 'reduce': reduce,
+                       'num_processes': num_processes, 'io_threads': io_threads, 'io_depth': io_depth, 'stretch': stretch}
+            worker = context.Process(target=_score_shard, args=(shard, start, paths[start:stop], options, results),
+                                     name='predict-shard-%d' % shard) # not daemonic: it starts its own loader processes
+            worker.start()
+            workers.append(worker)
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    try:
+        pending = set(range(len(workers)))
+        while pending:
+            try:
+                kind, shard, start, preds, tta_preds = results.get(timeout=poll)
+            except queue.Empty:
+                dead = [shard for shard in pending if workers[shard].exitcode not in (None, 0)]
+                if dead:
+                    raise RuntimeError('predict shard %d died (exit code %d)' % (dead[0], workers[dead[0]].exitcode))
+                continue
+            if kind == 'error':
+                raise RuntimeError('predict shard %d failed:\n%s' % (shard, start))
+            if kind == 'done':
+                pending.discard(shard)
+                continue
+            stop = start + len(preds)
+            scores[start:stop] = preds
+            tta_scores[start:stop] = tta_preds
+            if writer is not None:
+                writer.write(paths[start:stop], preds, tta_preds)
+    except BaseException:
+        for worker in workers:
+            worker.terminate()
+        raise
+    finally:
+        for worker in workers:
+            worker.join()
+    return scores, tta_scores
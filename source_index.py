@@ -0,0 +1,74 @@
+"""
+Index of the header values (Einstein radius, magnitude, ...) of every training source,
+built once so that drawing sources never opens a FITS file just to reject it.
+
+Run this file once after create_training_ids.py to build source_index.npy in the data
+directory of load_data.registry, where the generators look for it.
+"""
+
+import numpy as np
+from astropy.io import fits
+
+index_name = 'source_index.npy' # in the data directory
+default_columns = ('LENSER', 'MAG')
+
+
+def build_index(cutout_dict, train_ids, path="data/training/sources/", columns=default_columns, index_path=None):
+    """
+    Reads the header of every source, in train_ids order. Returns a structured array with
+    the source id, `valid` (the file could be read) and one float column per header
+    keyword in `columns` (NaN where it is missing), also saved to index_path if given.
+    """
+    dtype = [('id', 'i8'), ('valid', '?')] + [(column, 'f8') for column in columns]
+    index = np.zeros(len(train_ids), dtype=dtype)
+    for i, img_id in enumerate(train_ids):
+        index[i]['id'] = img_id
+        try:
+            header = fits.getheader(path+cutout_dict[img_id]['name'])
+            index[i]['valid'] = True
+        except IOError:
+            header = {}
+        for column in columns:
+            index[i][column] = header.get(column, np.nan)
+    if index_path is not None:
+        np.save(index_path, index)
+    return index
+
+
+class SourceSampler(object):
+    """
+    Draws sources uniformly, with replacement, among those that are valid and pass all the
+    cuts, at O(1) per draw. cuts map an index column to a (min, max) range, either bound
+    may be None; sources with a NaN in a cut column never pass.
+    Draws are positions in train_ids_source, i.e. what the generators hand to the workers.
+    """
+
+    def __init__(self, index, **cuts):
+        keep = index['valid'].copy()
+        for column, (low, high) in cuts.items():
+            if low is not None:
+                keep &= index[column] >= low
+            if high is not None:
+                keep &= index[column] <= high
+        if not keep.any():
+            raise ValueError('No source passes the cuts {}'.format(cuts))
+        self.index = index
+        self.cuts = cuts
+        self.eligible = np.flatnonzero(keep)
+
+    def __len__(self):
+        return len(self.eligible)
+
+    def sample(self, n, rng=None):
+        """n eligible source indices, drawn with replacement from the np.random.Generator rng."""
+        if rng is None:
+            rng = np.random.default_rng()
+        return self.eligible[rng.integers(0, len(self.eligible), size=n)]
+
+
+if __name__ == "__main__":
+    import load_data
+    registry = load_data.registry
+    index_path = registry.data_path+index_name
+    index = build_index(registry.cutout_dict_train_source, registry.train_ids_source, path=registry.data_path+"training/sources/", index_path=index_path)
+    print("Saved %s (%d of %d sources readable)" % (index_path, index['valid'].sum(), len(index)))
@@ -0,0 +1,99 @@
+"""
+Streaming training driver. The positive and negative chunk generators are turned into
+one continuous sequence of shuffled, normalised minibatches and fed to the model with
+fit_generator, so Keras sets up its training loop once instead of once per minibatch,
+and the next minibatches are prepared on a background thread while the model trains.
+One Keras epoch is one chunk: epoch-level callbacks (ModelCheckpoint, CSVLogger,
+ReduceLROnPlateau) act once per chunk.
+"""
+
+import time
+import numpy as np
+from keras.callbacks import Callback
+import pipeline_metrics
+
+
+def iterate_minibatches(inputs, targets, batchsize, shuffle=False):
+    assert len(inputs) == len(targets)
+    if shuffle:
+        indices = np.arange(len(inputs))
+        np.random.shuffle(indices)
+    for start_idx in range(0, len(inputs) - batchsize + 1, batchsize):
+        if shuffle:
+            excerpt = indices[start_idx:start_idx + batchsize]
+        else:
+            excerpt = slice(start_idx, start_idx + batchsize)
+        yield inputs[excerpt], targets[excerpt]
+
+
+def steps_per_chunk(chunk_size, batch_size):
+    """Minibatches per chunk of chunk_size positives and chunk_size negatives."""
+    return (2 * chunk_size) // batch_size
+
+
+def minibatch_stream(train_gen_pos, train_gen_neg, batch_size, rescale=None, shuffle=True, metrics=None):
+    """
+    Minibatches over the chunks of train_gen_pos and train_gen_neg, in the order the
+    per-batch loop of cnn.main used to fit them. The images keep the dtype of the chunks
+    (uint8 from the training generators): models built with a rescale do it in-graph.
+    For other models, rescale=(scale, offset) turns each chunk into float32
+    images*scale - offset once, in place, instead of per minibatch.
+    Stops when either generator runs out. With a pipeline_metrics.Metrics, counts the
+    seconds blocked on each generator (the samples generated are counted where the
+    chunks are made, see pipeline_metrics.counting).
+    """
+    metrics = metrics or pipeline_metrics.Metrics()
+    while True:
+        try:
+            with metrics.timer('next_pos_seconds'):
+                chunk_data_pos, _ = next(train_gen_pos)
+            with metrics.timer('next_neg_seconds'):
+                chunk_data_neg, _ = next(train_gen_neg)
+        except StopIteration:
+            return
+        y_train_pos = chunk_data_pos.pop()
+        y_train_neg = chunk_data_neg.pop()
+
+        # concatenate copies the chunks out of the generators' buffers
+        X_train = np.concatenate((chunk_data_pos[0], chunk_data_neg[0]))
+        if rescale is not None:
+            X_train = X_train.astype('float32')
+            X_train *= rescale[0]
+            X_train -= rescale[1]
+        y_train = np.concatenate((y_train_pos, y_train_neg)).astype(np.int32)
+        y_train = np.expand_dims(y_train, axis=1)
+
+        for batch in iterate_minibatches(X_train, y_train, batch_size, shuffle=shuffle):
+            yield batch
+
+
+class StepLogger(Callback):
+    """Prints the mean loss and metrics, and the training throughput, every `every` minibatches."""
+
+    def __init__(self, every=50):
+        super(StepLogger, self).__init__()
+        self.every = every
+        self.step = 0
+        self.sums = {}
+        self.samples = 0
+
+    def on_train_begin(self, logs=None):
+        self.start_time = time.time()
+
+    def on_batch_end(self, batch, logs=None):
+        logs = logs or {}
+        self.step += 1
+        self.samples += logs.get('size', 0)
+        for key, value in logs.items():
+            if key not in ('batch', 'size'):
+                self.sums[key] = self.sums.get(key, 0.) + float(value)
+        if self.step % self.every == 0:
+            elapsed = time.time() - self.start_time
+            means = ' '.join('%s %.4f' % (key, value / self.every) for key, value in sorted(self.sums.items()))
+            print('step %d %s (%.1f samples/s)' % (self.step, means, self.samples / elapsed))
+            self.sums = {}
+            self.samples = 0
+            self.start_time = time.time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        print('chunk %d done' % epoch)
@@ -0,0 +1,59 @@
+"""
+Test-time augmentation over the symmetries of the square (the dihedral group D4).
+
+Every symmetry is a strided view of the (N,H,W,C) chunk, and all the requested ones
+are scored together: the transformed copies are concatenated into large batches and
+sent through one model.predict per batch, then reduced per object.
+"""
+
+import numpy as np
+
+# The first four are the flips cnn.main used to average over, in the same order.
+symmetries = [
+    ('identity', lambda X: X),
+    ('flipud', lambda X: X[:, ::-1]),
+    ('rot180', lambda X: X[:, ::-1, ::-1]),
+    ('fliplr', lambda X: X[:, :, ::-1]),
+    ('rot90', lambda X: np.rot90(X, 1, axes=(1, 2))),
+    ('rot270', lambda X: np.rot90(X, 3, axes=(1, 2))),
+    ('transpose', lambda X: X.transpose(0, 2, 1, 3)),
+    ('antitranspose', lambda X: X[:, ::-1, ::-1].transpose(0, 2, 1, 3)),
+]
+
+reductions = {
+    'mean': np.mean,
+    'max': np.max,
+    'median': np.median,
+}
+
+
+def views(X, num_transforms=4):
+    """The first num_transforms (1 to 8) symmetries of the (N,H,W,C) chunk X, as views."""
+    if not 1 <= num_transforms <= len(symmetries):
+        raise ValueError('num_transforms must be between 1 and %d, got %s' % (len(symmetries), num_transforms))
+    if num_transforms > 4 and X.shape[1] != X.shape[2]:
+        raise ValueError('rotations and transpositions need square images, got %sx%s' % X.shape[1:3])
+    return [transform(X) for _, transform in symmetries[:num_transforms]]
+
+
+def predict_tta(model, X, num_transforms=4, reduce='mean', max_batch=2048, batch_size=32, return_all=False):
+    """
+    Scores the chunk X under num_transforms symmetries and reduces them per object with
+    `reduce` ('mean', 'max' or 'median'). The transformed copies of up to
+    max_batch // num_transforms objects go through a single model.predict call.
+    Returns the (N, outputs) reduced scores and, with return_all, also the
+    (num_transforms, N, outputs) scores of every symmetry.
+    """
+    if reduce not in reductions:
+        raise ValueError('reduce must be one of %s, got %r' % (sorted(reductions), reduce))
+    per_call = max(1, max_batch // num_transforms)
+    scores = []
+    for start in range(0, len(X), per_call):
+        block = views(X[start:start + per_call], num_transforms)
+        preds = model.predict(np.concatenate(block), batch_size=batch_size)
+        scores.append(preds.reshape((num_transforms, len(block[0])) + preds.shape[1:]))
+    scores = np.concatenate(scores, axis=1)
+    reduced = reductions[reduce](scores, axis=0)
+    if return_all:
+        return reduced, scores
+    return reduced